@@ -29,13 +29,21 @@
 # Type: SMU
 # Device: Keysight N6705
 
+import os
+import json
+import math
+import time
+import numpy as np
 from collections import OrderedDict
+from pyvisa import constants
 from EmptyDeviceClass import EmptyDevice
 from ErrorMessage import debug
 
 
 class Device(EmptyDevice):
 
+    actions = ["benchmark_transfer"]
+
     description = """
                         Keysight N6705
                         DC power analyzer
@@ -58,15 +66,61 @@ class Device(EmptyDevice):
 
         self.shortname = "Keysight N6705"
 
-        self.variables = ["Voltage", "Current", "OVP", "OCP"]
-        self.units = ["V", "A", "", ""]
-        self.plottype = [True, True, True, True]  # True to plot data
-        self.savetype = [True, True, True, True]  # True to save data
+        self.variables = ["Voltage", "Current", "OVP", "OCP", "Round trips"]
+        self.units = ["V", "A", "", "", ""]
+        self.plottype = [True, True, True, True, False]  # True to plot data
+        self.savetype = [True, True, True, True, True]  # True to save data
 
         self.port_manager = True
         self.port_types = ["TCPIP", "GPIB"]
 
-        self.channel_model = None
+        self.channel_models = dict()
+
+        # module capabilities per mainframe serial number, persisted to a local file
+        self.capabilities_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), "capabilities.json")
+        self.capabilities = dict()
+        # entries written by another cache layout are discovered again
+        self.capabilities_version = 2
+
+        # number of write/read round trips done in the last call()
+        self.roundtrips = 0
+
+        # list sweep: max number of steps and digitizer points per run
+        self.list_max_steps = 512
+        self.list_max_points = 32768
+        # digitizer sampling period in s
+        self.tint_min = 20.48e-6
+
+        # operation status bits of trigger systems waiting for a trigger (WTG-meas, WTG-tran)
+        self.wtg_meas = 1 << 3
+        self.wtg_tran = 1 << 5
+        self.wtg_timeout = 5
+
+        # power line frequency detected from the pickup of a capture, only accepted with a clear margin
+        self.detected_line_frequency = None
+        self.line_frequency_margin = 3
+
+        # command queue to send several writes as one message
+        self.queue = []
+        self.queue_active = False
+        self.max_message_length = 1024
+        self.transactions_saved = 0
+
+        # last value written per SCPI header, actions and output state are never skipped
+        self.shadow = dict()
+        self.shadow_exclude = ("OUTP", "OUTPUT", "OUTP:STAT", "OUTPUT:STATE")
+
+        # protection service request
+        self.srq_events = False
+        self.srq_pending = False
+        self.srq_handler = None
+
+        # software autorange: range is increased above 95 % and decreased below 50 % of the next lower range
+        self.range_up = 0.95
+        self.range_down = 0.5
+
+        # statistics calculated on digitized arrays
+        self.statistics = ["mean", "rms", "min", "max", "pp"]
 
         self.commands = {
             "Voltage in V": "VOLT",
@@ -90,16 +144,25 @@ class Device(EmptyDevice):
     def set_GUIparameter(self):
         gui_parameter = {
             "SweepMode": ["Voltage in V", "Current A"],
-            "Channel": ["1", "2", "3", "4"],
-            "Range": list(self.current_ranges.keys()),
+            "Channel": ["1", "2", "3", "4", "1:2", "3:4", "1:4"],
+            "Range": list(self.current_ranges.keys()) + ["Auto"],
             "RangeVoltage": list(self.voltage_ranges.keys()),
             "Compliance": 100e-6,
             "4wire": False,
-            "Speed": ["Fast", "Medium", "Slow"],
+            "Speed": ["Fast", "Medium", "Slow", "Target noise"],
+            "TargetNoise": 1e-3,
+            "LineFrequency": ["Auto", "50 Hz", "60 Hz"],
             "CheckPulse": False,
             "PulseOnTime": 0.5,
             "PulseOffTime": 0.5,
             "PulseOffLevel": 0.0,
+            "CombinedQuery": True,
+            "ListSweep": False,
+            "ListValues": "",
+            "ListDwell": 0.1,
+            "ArrayStatistics": False,
+            "DataFormat": ["ASCII", "Binary"],
+            "ProtectionSRQ": False,
         }
 
         return gui_parameter
@@ -108,135 +171,852 @@ class Device(EmptyDevice):
         self.source = parameter['SweepMode']
         self.protection = parameter['Compliance']
         self.vrange = self.voltage_ranges[parameter["RangeVoltage"]]
-        self.irange = self.current_ranges[parameter["Range"]]
+        # software autorange starts from the largest range
+        self.autorange = parameter["Range"] == "Auto"
+        if self.autorange:
+            self.irange = list(self.current_ranges.values())[0]
+        else:
+            self.irange = self.current_ranges[parameter["Range"]]
         self.four_wires = parameter["4wire"]
         self.speed = parameter["Speed"]
+        # relative noise of the measured quantity in 'Target noise' mode
+        self.target_noise = float(parameter.get("TargetNoise", 1e-3))
+        self.line_frequency = parameter.get("LineFrequency", "Auto")
 
         self.pulse = parameter['CheckPulse']  
         self.ton = float(parameter["PulseOnTime"])
         self.toff = float(parameter["PulseOffTime"])
         self.pulseofflevel = parameter['PulseOffLevel']
 
+        self.combined_query = parameter.get("CombinedQuery", True)
+
+        # hardware timed list sweep, values are comma separated
+        self.list_sweep = parameter.get("ListSweep", False)
+        self.list_values = [float(v) for v in str(parameter.get("ListValues", "")).split(",") if v.strip()]
+        self.list_dwell = float(parameter.get("ListDwell", 0.1))
+
+        # statistics of the digitized voltage and current arrays
+        self.array_statistics = parameter.get("ArrayStatistics", False)
+
+        # format of array readbacks
+        self.data_format = parameter.get("DataFormat", "ASCII")
+
+        # protection trips are signaled by service request instead of a query at each point
+        self.protection_srq = parameter.get("ProtectionSRQ", False)
+
         self.device = parameter['Device']
+
+        # single channel or SCPI channel range (e.g. '1:4')
         self.channel = parameter['Channel']
+        if ":" in self.channel:
+            first, last = self.channel.split(":")
+            self.channels = [str(ch) for ch in range(int(first), int(last) + 1)]
+        else:
+            self.channels = [self.channel]
+
+        # one set of variables per channel in multi-channel mode
+        self.variables = []
+        self.units = []
+        for variable, unit in [("Voltage", "V"), ("Current", "A"), ("OVP", ""), ("OCP", "")]:
+            if len(self.channels) > 1:
+                self.variables += [f"{variable} CH{ch}" for ch in self.channels]
+            else:
+                self.variables.append(variable)
+            self.units += [unit] * len(self.channels)
+        if self.array_statistics:
+            for variable, unit in [("Voltage", "V"), ("Current", "A")]:
+                for statistic in self.statistics:
+                    if len(self.channels) > 1:
+                        self.variables += [f"{variable} {statistic} CH{ch}" for ch in self.channels]
+                    else:
+                        self.variables.append(f"{variable} {statistic}")
+                    self.units += [unit] * len(self.channels)
+        self.variables.append("Round trips")
+        self.units.append("")
+        self.plottype = [True] * (len(self.variables) - 1) + [False]  # True to plot data
+        self.savetype = [True] * len(self.variables)  # True to save data
 
     def initialize(self):
         self.port.port.read_termination = '\n'
         self.port.port.write_termination = '\n'
+        self.queue = []
+        self.queue_active = False
+        self.transactions_saved = 0
+        self.shadow = dict()
+        self.detected_line_frequency = None
         # once at the beginning of the measurement
-        self.port.write("*RST")
+        self.write("*RST")
+        self.load_capabilities()
 
-    def configure(self):
+        # binary arrays as IEEE-488.2 definite length blocks of little endian 32-bit floats
+        if self.data_format == "Binary":
+            self.write("FORM:DATA REAL;:FORM:BORD SWAP")
 
-        self.port.write(f"SYST:CHAN:MODEL? (@{self.channel})")
-        self.channel_model = self.port.read()
+    def deinitialize(self):
+        # final commands are sent directly, also if a phase has left commands queued
+        self.stop_queue()
+        if self.protection_srq:
+            self.disable_srq()
+        debug(f"Keysight N6705: {self.transactions_saved} bus transactions saved by command queue")
+
+    def configure(self):
+        self.start_queue()
+        try:
+            for ch in self.channels:
+                self.channel_models[ch] = self.get_capabilities(ch)["model"]
+
+                # the instrument has the final word on ranges, an unexpected one is only reported
+                current_ranges = self.get_capabilities(ch)["current_ranges"]
+                if not self.autorange and current_ranges is not None and self.irange not in current_ranges:
+                    debug(f"Keysight N6705: current range {self.irange} A is outside the ranges reported by channel {ch} ({self.channel_models[ch]})")
+
+            # channels are grouped by module family to send model dependent settings once
+            n678_channels = [ch for ch in self.channels if self.channel_models[ch].startswith('N678')]
+            other_channels = [ch for ch in self.channels if ch not in n678_channels]
+
+            if self.source.startswith("Voltage"):
+                # 4 wires
+                if self.four_wires:
+                    self.write(f"VOLT:SENSE:SOURCE EXT, (@{self.channel})")
+                else:
+                    self.write(f"VOLT:SENSE:SOURCE INT, (@{self.channel})")
+                # sourcemode fix
+                self.write(f"VOLT:MODE FIX, (@{self.channel})")
+                #
+                # voltage protection (OVP) level
+                # VOLT:PROT value, (@ch)
+                #
+                # compliance
+                if n678_channels:
+                    self.write(
+                        f"CURR:LIMIT {self.protection}, {self.chanlist(n678_channels)}")
+                if other_channels:
+                    self.write(f"CURR {self.protection}, {self.chanlist(other_channels)}")
+                    self.write(f"CURR:PROT:STAT ON, {self.chanlist(other_channels)}")
+                # pulse
+                if self.pulse:
+                    self.pulsemode = "VOLTAGE"
+
+            elif self.source.startswith("Current"):
+                # sourcemode fix
+                self.write(f"CURR:MODE FIX, (@{self.channel})")
+                #
+                # current protection (OCP) level
+                # CURR:LIMIT value, (@ch)   (N678x)
+                # CURR value, (@ch)         (other)
+                # CURR:PROT:STAT ON, (@ch)
+                #
+                # compliance
+                if n678_channels:
+                    self.write(
+                        f"VOLT:PROT:REMOTE {self.protection}, {self.chanlist(n678_channels)}")
+                if other_channels:
+                    self.write(
+                        f"VOLT:PROT {self.protection}, {self.chanlist(other_channels)}")
+                # pulse
+                if self.pulse:
+                    self.pulsemode = "CURRENT"
 
-        if self.source.startswith("Voltage"):
-            # 4 wires
-            if self.four_wires:
-                self.port.write(f"VOLT:SENSE:SOURCE EXT, (@{self.channel})")
-            else:
-                self.port.write(f"VOLT:SENSE:SOURCE INT, (@{self.channel})")
-            # sourcemode fix
-            self.port.write(f"VOLT:MODE FIX, (@{self.channel})")
-            #
-            # voltage protection (OVP) level
-            # VOLT:PROT value, (@ch)
-            #
-            # compliance
-            if self.channel_model.startswith('N678'):
-                self.port.write(
-                    f"CURR:LIMIT {self.protection}, (@{self.channel})")
-            else:
-                self.port.write(f"CURR {self.protection}, (@{self.channel})")
-                self.port.write(f"CURR:PROT:STAT ON, (@{self.channel})")
-            # pulse
-            if self.pulse:
-                self.pulsemode = "VOLTAGE"
-
-        elif self.source.startswith("Current"):
-            # sourcemode fix
-            self.port.write(f"CURR:MODE FIX, (@{self.channel})")
-            #
-            # current protection (OCP) level
-            # CURR:LIMIT value, (@ch)   (N678x)
-            # CURR value, (@ch)         (other)
-            # CURR:PROT:STAT ON, (@ch)
-            #
-            # compliance
-            if self.channel_model.startswith('N678'):
-                self.port.write(
-                    f"VOLT:PROT:REMOTE {self.protection}, (@{self.channel})")
-            else:
-                self.port.write(
-                    f"VOLT:PROT {self.protection}, (@{self.channel})")
             # pulse
             if self.pulse:
-                self.pulsemode = "CURRENT"
-
-        # pulse
-        if self.pulse:
-            self.port.write(f"{self.pulsemode}:MODE ARB, (@{self.channel})")
-            self.port.write(f"ARB:FUNC:SHAPE PULSE, (@{self.channel})")
-            self.port.write(f"ARB:FUNC:TYPE {self.pulsemode}, (@{self.channel})")
-            self.port.write(f"ARB:COUNT INF, (@{self.channel})")
-
-        self.port.write(f"SENSE:VOLT:RANGE {self.vrange}, (@{self.channel})")
-        self.port.write(f"SENSE:CURR:RANGE {self.irange}, (@{self.channel})")
-
-        self.npoints = 3906        # 50 Hz power line  (= medium)
-        # self.npoints = 3255        # 60 Hz power line (= medium)
-
-        if self.speed == "Fast":
-            # 0.1 NPLC
-            self.npoints = int(self.npoints/10)
-        elif self.speed == "Slow":
-            # 10 NPLC
-            self.npoints *= 10
-
-        self.port.write(f"SENSE:SWEEP:POINTS {self.npoints}, (@{self.channel})")
+                self.write(f"{self.pulsemode}:MODE ARB, (@{self.channel})")
+                self.write(f"ARB:FUNC:SHAPE PULSE, (@{self.channel})")
+                self.write(f"ARB:FUNC:TYPE {self.pulsemode}, (@{self.channel})")
+                self.write(f"ARB:COUNT INF, (@{self.channel})")
+                # timing parameters are uploaded once, only top level changes at each point
+                self.write(f"ARB:{self.pulsemode}:PULSE:START:TIME {float(self.toff/2)}, (@{self.channel})")
+                self.write(f"ARB:{self.pulsemode}:PULSE:START:LEVEL {self.pulseofflevel}, (@{self.channel})")
+                self.write(f"ARB:{self.pulsemode}:PULSE:TOP:TIME {self.ton}, (@{self.channel})")
+                self.write(f"ARB:{self.pulsemode}:PULSE:END:TIME {float(self.toff)/2}, (@{self.channel})")
+
+            self.write(f"SENSE:VOLT:RANGE {self.vrange}, (@{self.channel})")
+            self.write(f"SENSE:CURR:RANGE {self.irange}, (@{self.channel})")
+
+            if self.autorange:
+                self.reset_autorange()
+
+            if self.protection_srq:
+                self.enable_srq()
+
+            # points per power line cycle, e.g. 976 @ 50 Hz and 814 @ 60 Hz
+            self.plc_points = 1 / (self.get_line_frequency() * self.tint_min)
+
+            self.npoints = round(4 * self.plc_points)        # medium
+
+            if self.speed == "Fast":
+                # 0.1 NPLC
+                self.npoints = int(self.npoints/10)
+            elif self.speed == "Slow":
+                # 10 NPLC
+                self.npoints *= 10
+
+            # integration time is chosen by a calibration capture at the first point
+            self.noise_calibrated = False
+
+            self.write(f"SENSE:SWEEP:POINTS {self.npoints}, (@{self.channel})")
+
+            # list sweep
+            if self.list_sweep:
+                self.configure_list()
+
+            # array statistics need simultaneous voltage and current digitizing
+            if self.array_statistics:
+                if self.list_sweep:
+                    raise Exception("array statistics cannot be used with list sweep")
+                for ch in self.channels:
+                    if not self.channel_models[ch].startswith(('N676', 'N678')):
+                        raise Exception(f"array statistics not supported by channel {ch} ({self.channel_models[ch]})")
+                self.write(f"SENSE:FUNC:VOLT ON, (@{self.channel})")
+                self.write(f"SENSE:FUNC:CURR ON, (@{self.channel})")
+        finally:
+            self.stop_queue()
 
     def poweron(self):
-        if self.pulse:
-            self.port.write(f"ARB:COUNT INF, (@{self.channel})")
-            self.port.write(f"TRIG:ARB:SOURCE IMM")
-            self.port.write(f"OUTP ON, (@{self.channel})")
-            self.port.write(f"INIT:TRAN (@{self.channel})")
-        else:
-            self.port.write(f"OUTP ON, (@{self.channel})")
+        self.start_queue()
+        try:
+            if self.pulse:
+                self.write(f"ARB:COUNT INF, (@{self.channel})")
+                self.write(f"TRIG:ARB:SOURCE IMM")
+                self.write(f"OUTP ON, (@{self.channel})")
+                self.write(f"INIT:TRAN (@{self.channel})")
+            else:
+                self.write(f"OUTP ON, (@{self.channel})")
+        finally:
+            self.stop_queue()
+
+        # list is run at the first sweep point
+        self.list_index = 0
 
     def poweroff(self):
-        self.port.write(f"OUTP OFF, (@{self.channel})")
+        self.stop_queue()
+        self.write(f"OUTP OFF, (@{self.channel})")
         if self.pulse:
-            self.port.write(f"ABORT:TRAN (@{self.channel})")
+            self.write(f"ABORT:TRAN (@{self.channel})")
 
     def apply(self):
+        # a protection trip stops the sweep before the next point is applied
+        if self.protection_srq:
+            self.check_protection()
+
+        # list sweep
+        if self.list_sweep:
+            if self.list_index >= len(self.list_values) or float(self.value) != self.list_values[self.list_index]:
+                raise Exception(f"sweep value {self.value} does not match list sweep values")
+            if self.list_index == 0:
+                self.run_list()
         # pulse
-        if self.pulse:
-            self.port.write(f"ABORT:TRAN (@{self.channel}); *WAI")  # wait for pending abort                       
-            self.port.write(f"ARB:{self.pulsemode}:PULSE:START:TIME {float(self.toff/2)}, (@{self.channel})")
-            self.port.write(f"ARB:{self.pulsemode}:PULSE:START:LEVEL {self.pulseofflevel}, (@{self.channel})")
-            self.port.write(f"ARB:{self.pulsemode}:PULSE:TOP:TIME {self.ton}, (@{self.channel})")
-            self.port.write(f"ARB:{self.pulsemode}:PULSE:TOP:LEVEL {self.value}, (@{self.channel})")
-            self.port.write(f"ARB:{self.pulsemode}:PULSE:END:TIME {float(self.toff)/2}, (@{self.channel})")
-            self.port.write(f"INIT:TRAN (@{self.channel})")
+        elif self.pulse:
+            # new top level and re-arm in one message, completion is checked once at the end
+            self.query(f"ABORT:TRAN (@{self.channel});"
+                       f":ARB:{self.pulsemode}:PULSE:TOP:LEVEL {self.value}, (@{self.channel});"
+                       f":INIT:TRAN (@{self.channel});*OPC?")
         else:
-            self.port.write(f"{self.commands[self.source]} {self.value}, (@{self.channel})")
+            self.write(f"{self.commands[self.source]} {self.value}, (@{self.channel})")
 
     def call(self):
-        self.port.write(f"MEAS:VOLT? (@{self.channel})")
-        voltage = float(self.port.read())
+        # list sweep results have been fetched at once
+        if self.list_sweep:
+            results = self.list_results[self.list_index]
+            self.list_index += 1
+            return results
+
+        self.roundtrips = 0
+
+        if self.speed == "Target noise" and not self.noise_calibrated:
+            self.calibrate_integration()
+
+        results = self.call_point()
+
+        if self.autorange:
+            nchannels = len(self.channels)
+            # the point is measured again only if its own reading needs another range
+            if self.update_ranges(results[nchannels:2 * nchannels]):
+                results = self.call_point()
+                results[-1] = self.roundtrips
+            # range for the next point is predicted from the recent readings
+            self.predict_ranges(results[nchannels:2 * nchannels])
+
+        return results
+
+    def call_point(self):
+        if self.array_statistics:
+            return self.call_array()
 
         # modules N6761A and N6762A have simultaneous V/I measurement
-        if self.channel_model.startswith('N676'):
-            self.port.write(f"FETCH:CURR? (@{self.channel})")
+        if all(self.channel_models[ch].startswith('N676') for ch in self.channels):
+            current_query = f"FETCH:CURR? (@{self.channel})"
+        else:
+            current_query = f"MEAS:CURR? (@{self.channel})"
+
+        queries = [
+            f"MEAS:VOLT? (@{self.channel})",
+            current_query,
+        ]
+        if not self.protection_srq:
+            # check questionable status condition register
+            queries.append(f"STAT:QUES:COND? (@{self.channel})")
+
+        if self.combined_query:
+            # all queries in one message, answers are separated by ';'
+            answers = self.query(";:".join(queries)).split(";")
+        else:
+            answers = [self.query(q) for q in queries]
+
+        # each answer holds one comma separated value per channel
+        voltages = [float(v) for v in answers[0].split(",")]
+        currents = [float(i) for i in answers[1].split(",")]
+        if self.protection_srq:
+            regvalues = self.protection_status()
+        else:
+            regvalues = [int(float(r)) for r in answers[2].split(",")]
+
+        ovp = [bool(regvalue & (1)) for regvalue in regvalues]
+        ocp = [bool(regvalue & (1<<1)) for regvalue in regvalues]
+
+        return voltages + currents + ovp + ocp + [self.roundtrips]
+
+    # convenience functions
+
+    def load_capabilities(self):
+        # mainframe serial number and installed module set, one round trip each
+        idn, count = self.query("*IDN?;:SYST:CHAN:COUN?").split(";")
+        self.serial = idn.split(",")[2].strip()
+        modules = [m.strip() for m in self.query(f"SYST:CHAN:MODEL? (@1:{int(count)})").split(",")]
+
+        cache = dict()
+        if os.path.isfile(self.capabilities_file):
+            try:
+                with open(self.capabilities_file, 'r') as f:
+                    cache = json.load(f)
+            except (OSError, ValueError):
+                cache = dict()
+
+        self.capabilities = cache.get(self.serial, dict())
+
+        # invalidate cached capabilities if modules have been changed
+        if self.capabilities.get("modules") != modules or self.capabilities.get("version") != self.capabilities_version:
+            self.capabilities = {"modules": modules, "channels": dict(), "version": self.capabilities_version}
+
+    def save_capabilities(self):
+        cache = dict()
+        if os.path.isfile(self.capabilities_file):
+            try:
+                with open(self.capabilities_file, 'r') as f:
+                    cache = json.load(f)
+            except (OSError, ValueError):
+                cache = dict()
+
+        # channels with unknown ranges are not stored
+        channels = {ch: c for ch, c in self.capabilities["channels"].items() if c["current_ranges"] is not None}
+        cache[self.serial] = dict(self.capabilities, channels=channels)
+
+        try:
+            with open(self.capabilities_file, 'w') as f:
+                json.dump(cache, f, indent=2)
+        except OSError as e:
+            debug(f"Keysight N6705: unable to save capabilities cache ({e})")
+
+    def get_capabilities(self, channel):
+        channels = self.capabilities["channels"]
+
+        if channel not in channels:
+            model = self.capabilities["modules"][int(channel) - 1]
+            options = [o.strip().strip('"') for o in self.query(f"SYST:CHAN:OPT? (@{channel})").split(",")]
+            options = [o for o in options if o]
+
+            # measurement range limits reported by the module itself, e.g. the 100 µA/200 µA option ranges
+            try:
+                answer = self.query(f"SENS:CURR:RANG? MIN, (@{channel});:SENS:CURR:RANG? MAX, (@{channel})")
+                low, high = [float(r) for r in answer.split(";")]
+                current_ranges = [r for r in self.current_ranges.values() if low <= float(r) <= high]
+            except Exception as e:
+                debug(f"Keysight N6705: current ranges of channel {channel} ({model}) unknown ({e})")
+                current_ranges = None
+
+            channels[channel] = {
+                "model": model,
+                "options": options,
+                "current_ranges": current_ranges,
+                "voltage_ranges": list(self.voltage_ranges.values()),
+            }
+            self.save_capabilities()
+
+        return channels[channel]
+
+    # SOFTWARE AUTORANGE
+
+    def reset_autorange(self):
+        self.range_values = {ch: sorted(float(r) for r in self.get_capabilities(ch)["current_ranges"] or self.current_ranges.values())
+                             for ch in self.channels}
+        self.range_selected = {ch: self.range_values[ch][-1] for ch in self.channels}
+        self.range_history = {ch: [] for ch in self.channels}
+
+    def select_range(self, ch, current):
+        # smallest range fitting the current, with hysteresis between up and down ranging
+        ranges = self.range_values[ch]
+        selected = self.range_selected[ch]
+
+        if current > self.range_up * selected:
+            larger = [r for r in ranges if current <= self.range_up * r]
+            return larger[0] if larger else ranges[-1]
+
+        smaller = [r for r in ranges if r < selected and current <= self.range_down * r]
+        return smaller[0] if smaller else selected
+
+    def set_range(self, ch, value):
+        if value == self.range_selected[ch]:
+            return False
+        self.range_selected[ch] = value
+        self.write(f"SENSE:CURR:RANGE {value}, (@{ch})")
+        return True
+
+    def update_ranges(self, currents):
+        changed = False
+        for ch, current in zip(self.channels, currents):
+            changed |= self.set_range(ch, self.select_range(ch, abs(current)))
+        return changed
+
+    def predict_ranges(self, currents):
+        for ch, current in zip(self.channels, currents):
+            history = self.range_history[ch]
+            history.append(abs(current))
+            del history[:-2]
+            # linear extrapolation of the last two readings
+            predicted = max(0, 2 * history[-1] - history[0])
+            self.set_range(ch, self.select_range(ch, predicted))
+
+    # INTEGRATION TIME
+
+    def get_line_frequency(self):
+        if self.line_frequency != "Auto":
+            return float(self.line_frequency.split(" ")[0])
+
+        # detected once per run, the pickup depends on the wiring of the measurement
+        if self.detected_line_frequency is None:
+            self.detected_line_frequency = self.detect_line_frequency()
+
+        return self.detected_line_frequency
+
+    def detect_line_frequency(self):
+        # power line pickup in a 0.4 s voltage capture, compared at 50 Hz and 60 Hz harmonics
+        ch = self.channels[0]
+        tint = 5 * self.tint_min
+        npoints = 4096
+        self.write(f"SENSE:SWEEP:TINT {tint}, (@{ch})")
+        self.write(f"SENSE:SWEEP:POINTS {npoints}, (@{ch})")
+        data = self.to_array(self.query_fields(f"MEAS:ARR:VOLT? (@{ch})")[0])
+        self.write(f"SENSE:SWEEP:TINT {self.tint_min}, (@{ch})")
+
+        spectrum = np.abs(np.fft.rfft(data - data.mean()))
+        frequencies = np.fft.rfftfreq(len(data), tint)
+
+        def power(f):
+            return sum(spectrum[np.argmin(np.abs(frequencies - n * f))] for n in (1, 2, 3))
+
+        # the stronger line must clearly stand out against the other one and the noise floor,
+        # e.g. with the output off or well shielded leads there is hardly any pickup
+        strong, weak = sorted([power(50.0), power(60.0)], reverse=True)
+        noise = 3 * np.median(spectrum)     # three harmonics of the noise floor
+        if strong < self.line_frequency_margin * weak or strong < self.line_frequency_margin * noise:
+            debug("Keysight N6705: power line frequency could not be detected, using 50 Hz, "
+                  "select LineFrequency 50 Hz or 60 Hz to set it")
+            return 50.0
+
+        line_frequency = 50.0 if power(50.0) > power(60.0) else 60.0
+        debug(f"Keysight N6705: power line frequency detected as {line_frequency:.0f} Hz")
+
+        return line_frequency
+
+    def calibrate_integration(self):
+        # smallest integration time whose block averages meet the target relative noise
+        quantity = "CURR" if self.source.startswith("Voltage") else "VOLT"
+        capture = round(40 * self.plc_points)
+        candidates = [0.1, 0.2, 0.5, 1, 2, 4, 10]   # NPLC, at least 4 blocks per capture
+
+        self.write(f"SENSE:SWEEP:POINTS {capture}, (@{self.channel})")
+
+        # the slowest channel sets the integration time of the channel list
+        nplc = 0
+        for ch in self.channels:
+            data = self.to_array(self.query_fields(f"MEAS:ARR:{quantity}? (@{ch})")[0])
+            level = abs(data.mean())
+            for candidate in candidates:
+                blocksize = max(1, round(candidate * self.plc_points))
+                blocks = data[:(len(data) // blocksize) * blocksize].reshape(-1, blocksize).mean(axis=1)
+                if level > 0 and blocks.std() / level <= self.target_noise:
+                    break
+            else:
+                candidate = 40
+            nplc = max(nplc, candidate)
+
+        self.npoints = round(nplc * self.plc_points)
+        self.write(f"SENSE:SWEEP:POINTS {self.npoints}, (@{self.channel})")
+        self.noise_calibrated = True
+
+        debug(f"Keysight N6705: integration time set to {nplc} NPLC for {self.target_noise} relative noise")
+
+    # PROTECTION SRQ
+
+    def enable_srq(self):
+        # OV (bit 0) and OC (bit 1) transitions set the questionable summary bit (bit 3) of the status byte
+        self.write("*CLS")
+        self.write(f"STAT:QUES:PTR 3, (@{self.channel})")
+        self.write(f"STAT:QUES:NTR 3, (@{self.channel})")
+        self.write(f"STAT:QUES:ENAB 3, (@{self.channel})")
+        self.write("*SRE 8")
+
+        self.protection_flags = [0] * len(self.channels)
+        self.srq_pending = False
+
+        # asynchronous notification, serial poll at each point if the interface has no SRQ events
+        # the handler is installed once per run, configure is called for each sweep
+        if self.srq_handler is not None:
+            return
+        try:
+            self.srq_handler = self.port.port.wrap_handler(self.on_srq)
+            self.port.port.install_handler(constants.EventType.service_request, self.srq_handler)
+            self.port.port.enable_event(constants.EventType.service_request, constants.EventMechanism.handler)
+            self.srq_events = True
+        except Exception as e:
+            debug(f"Keysight N6705: SRQ events not available, using serial poll ({e})")
+            self.srq_events = False
+
+    def disable_srq(self):
+        # no service requests after the measurement
+        self.write("*SRE 0")
+        self.write(f"STAT:QUES:ENAB 0, {self.chanlist(self.channels)}")
+
+        if self.srq_events:
+            try:
+                self.port.port.disable_event(constants.EventType.service_request, constants.EventMechanism.handler)
+                self.port.port.uninstall_handler(constants.EventType.service_request, self.srq_handler)
+            except Exception:
+                pass
+        self.srq_events = False
+        self.srq_handler = None
+
+    def on_srq(self, resource, event, user_handle):
+        # no bus traffic in the event thread, the trip is handled at the next driver call
+        self.srq_pending = True
+
+    def protection_status(self):
+        # cached questionable condition, updated only after a service request
+        if not self.srq_events:
+            self.srq_pending = bool(self.port.port.read_stb() & (1 << 6))
+
+        if self.srq_pending:
+            self.srq_pending = False
+            if self.srq_events:
+                # serial poll clears the request
+                self.port.port.read_stb()
+            answer = self.query(f"STAT:QUES:COND? (@{self.channel});:STAT:QUES:EVEN? (@{self.channel})")
+            self.protection_flags = [int(float(r)) for r in answer.split(";")[0].split(",")]
+            for ch, regvalue in zip(self.channels, self.protection_flags):
+                if regvalue & 3:
+                    debug(f"Keysight N6705: protection tripped on channel {ch} (OV: {bool(regvalue & 1)}, OC: {bool(regvalue & 2)})")
+
+        return self.protection_flags
+
+    def check_protection(self):
+        # SRQ events are handled at once, the serial poll fallback is done only once per point in call()
+        if self.srq_events and self.srq_pending:
+            self.protection_status()
+        tripped = [ch for ch, regvalue in zip(self.channels, self.protection_flags) if regvalue & 3]
+        if tripped:
+            raise Exception(f"Keysight N6705: protection tripped on channel {', '.join(tripped)}, sweep stopped")
+
+    # ARRAY STATISTICS
+
+    def call_array(self):
+        # one acquisition for all channels, then voltage and current arrays are fetched from it
+        self.write(f"INIT:ACQ (@{self.channel})")
+        self.wait_for_trigger(self.wtg_meas)
+
+        queries = [f"TRIG:ACQ (@{self.channel})"]
+        for ch in self.channels:
+            queries.append(f"FETCH:ARR:VOLT? (@{ch})")
+            queries.append(f"FETCH:ARR:CURR? (@{ch})")
+        if not self.protection_srq:
+            queries.append(f"STAT:QUES:COND? (@{self.channel})")
+
+        if self.combined_query:
+            answers = self.query_fields(";:".join(queries))
+        else:
+            self.write(queries[0])
+            answers = [field for q in queries[1:] for field in self.query_fields(q)]
+
+        nchannels = len(self.channels)
+        voltages = [self.to_array(a) for a in answers[0:2 * nchannels:2]]
+        currents = [self.to_array(a) for a in answers[1:2 * nchannels:2]]
+        if self.protection_srq:
+            regvalues = self.protection_status()
         else:
-            self.port.write(f"MEAS:CURR? (@{self.channel})")
+            regvalues = [int(float(r)) for r in answers[-1].split(",")]
+
+        ovp = [bool(regvalue & (1)) for regvalue in regvalues]
+        ocp = [bool(regvalue & (1<<1)) for regvalue in regvalues]
+
+        voltage_statistics = self.array_stats(np.vstack(voltages))
+        current_statistics = self.array_stats(np.vstack(currents))
+
+        results = list(voltage_statistics["mean"]) + list(current_statistics["mean"]) + ovp + ocp
+        for statistics in [voltage_statistics, current_statistics]:
+            for statistic in self.statistics:
+                results += list(statistics[statistic])
+
+        return results + [self.roundtrips]
+
+    def array_stats(self, data):
+        # statistics along each row (one row per channel)
+        minimum = data.min(axis=1)
+        maximum = data.max(axis=1)
+        return {
+            "mean": data.mean(axis=1),
+            "rms": np.sqrt(np.mean(np.square(data), axis=1)),
+            "min": minimum,
+            "max": maximum,
+            "pp": maximum - minimum,
+        }
 
-        current = float(self.port.read())
+    # LIST SWEEP
 
-        # check questionable status condition register
-        self.port.write(f"STAT:QUES:COND? (@{self.channel})")
-        regvalue = int(self.port.read())
-        
-        return [voltage, current, bool(regvalue & (1)), bool(regvalue & (1<<1))]
+    def configure_list(self):
+        if self.pulse:
+            raise Exception("list sweep cannot be used in pulse mode")
+        if not self.list_values:
+            raise Exception("list sweep needs at least one value")
+        if len(self.list_values) > self.list_max_steps:
+            raise Exception(f"list sweep supports up to {self.list_max_steps} values")
+
+        mode = self.commands[self.source]
+        nsteps = len(self.list_values)
+
+        # whole sweep vector and dwell times in one transfer each
+        self.write(f"{mode}:MODE LIST, (@{self.channel})")
+        self.write(f"LIST:{mode} {','.join(str(v) for v in self.list_values)}, (@{self.channel})")
+        self.write(f"LIST:DWELL {','.join([str(self.list_dwell)] * nsteps)}, (@{self.channel})")
+        self.write(f"LIST:COUNT 1, (@{self.channel})")
+        self.write(f"LIST:STEP AUTO, (@{self.channel})")
+        self.write(f"LIST:TERM:LAST ON, (@{self.channel})")
+
+        # digitizer records the whole list, both started by the same bus trigger
+        self.list_tint = max(self.tint_min, nsteps * self.list_dwell / self.list_max_points)
+        self.list_npoints = math.ceil(nsteps * self.list_dwell / self.list_tint)
+        self.write(f"SENSE:SWEEP:TINT {self.list_tint}, (@{self.channel})")
+        self.write(f"SENSE:SWEEP:POINTS {self.list_npoints}, (@{self.channel})")
+        self.write(f"SENSE:SWEEP:OFFSET:POINTS 0, (@{self.channel})")
+        self.write("TRIG:TRAN:SOURCE BUS")
+        self.write("TRIG:ACQ:SOURCE BUS")
+
+    def run_list(self):
+        self.roundtrips = 0
+        nsteps = len(self.list_values)
+
+        # list runs hardware timed, fetch blocks until acquisition is complete
+        timeout = self.port.port.timeout
+        self.port.port.timeout = timeout + nsteps * self.list_dwell * 1000
+
+        try:
+            self.write(f"INIT:TRAN (@{self.channel});:INIT:ACQ (@{self.channel})")
+            self.wait_for_trigger(self.wtg_tran | self.wtg_meas)
+            self.write("*TRG")
+
+            voltages = []
+            currents = []
+            for ch in self.channels:
+                voltage, current = [self.to_array(a) for a in self.query_fields(f"FETCH:ARR:VOLT? (@{ch});:FETCH:ARR:CURR? (@{ch})")]
+                voltages.append(self.list_step_means(voltage, nsteps))
+                currents.append(self.list_step_means(current, nsteps))
+        finally:
+            self.port.port.timeout = timeout
+
+        # protection bits latched during the whole list
+        regvalues = [int(float(r)) for r in self.query(f"STAT:QUES:EVEN? (@{self.channel})").split(",")]
+        ovp = [bool(regvalue & (1)) for regvalue in regvalues]
+        ocp = [bool(regvalue & (1<<1)) for regvalue in regvalues]
+
+        self.list_results = []
+        for step in range(nsteps):
+            self.list_results.append(
+                [v[step] for v in voltages] + [i[step] for i in currents] + ovp + ocp + [self.roundtrips if step == 0 else 0])
+
+    def list_step_means(self, data, nsteps):
+        # average the second half of each step to skip settling
+        data = data[:(len(data) // nsteps) * nsteps].reshape(nsteps, -1)
+        return data[:, data.shape[1] // 2:].mean(axis=1)
+
+    # BLOCK TRANSFER
+
+    def query_fields(self, cmd):
+        # answers of a (combined) query, arrays are kept as binary blocks in binary format
+        if self.data_format != "Binary":
+            return self.query(cmd).split(";")
+
+        self.flush()
+        self.port.write(cmd)
+        self.roundtrips += 1
+
+        # binary blocks may contain the termination character, read up to END
+        termination = self.port.port.read_termination
+        self.port.port.read_termination = None
+        try:
+            raw = self.port.port.read_raw()
+        finally:
+            self.port.port.read_termination = termination
+
+        return self.parse_fields(raw)
+
+    def parse_fields(self, raw):
+        # split a response into fields, definite length blocks become numpy views of the raw buffer
+        fields = []
+        pos = 0
+        while pos < len(raw):
+            if raw[pos:pos + 1] == b"#":
+                ndigits = int(raw[pos + 1:pos + 2])
+                nbytes = int(raw[pos + 2:pos + 2 + ndigits])
+                start = pos + 2 + ndigits
+                fields.append(np.frombuffer(raw, dtype='<f4', count=nbytes // 4, offset=start))
+                pos = start + nbytes
+            else:
+                end = raw.find(b";", pos)
+                if end < 0:
+                    end = len(raw)
+                fields.append(raw[pos:end].decode().strip())
+                pos = end
+            # skip separator and termination
+            while pos < len(raw) and raw[pos:pos + 1] in (b";", b"\n", b"\r"):
+                pos += 1
+        return fields
+
+    def to_array(self, field):
+        if isinstance(field, np.ndarray):
+            return field
+        return np.array(field.split(","), dtype=float)
+
+    def benchmark_transfer(self):
+        # compares ASCII and binary throughput of a full digitizer array of the first channel
+        ch = self.channels[0]
+        data_format = self.data_format
+        self.write(f"SENSE:SWEEP:POINTS {self.list_max_points}, (@{ch})")
+        self.write(f"INIT:ACQ (@{ch})")
+        self.wait_for_trigger(self.wtg_meas, ch)
+        self.write(f"TRIG:ACQ (@{ch})")
+
+        # format and points of the measurement are restored also if a transfer fails
+        try:
+            for benchmark_format, form in [("ASCII", "ASC"), ("Binary", "REAL;:FORM:BORD SWAP")]:
+                self.data_format = benchmark_format
+                self.write(f"FORM:DATA {form}")
+                repetitions = 5
+                tstart = time.perf_counter()
+                for _ in range(repetitions):
+                    data = self.to_array(self.query_fields(f"FETCH:ARR:VOLT? (@{ch})")[0])
+                telapsed = (time.perf_counter() - tstart) / repetitions
+                debug(f"Keysight N6705: {benchmark_format} transfer of {len(data)} points in {telapsed:.4f} s "
+                      f"({len(data) / telapsed:.0f} points/s)")
+        finally:
+            self.data_format = data_format
+            self.write("FORM:DATA REAL;:FORM:BORD SWAP" if self.data_format == "Binary" else "FORM:DATA ASC")
+            self.write(f"SENSE:SWEEP:POINTS {self.npoints}, (@{self.channel})")
+
+    def chanlist(self, channels):
+        # SCPI channel list, e.g. '(@1,3)'
+        return f"(@{','.join(channels)})"
+
+    def wait_for_trigger(self, bits, channel=None):
+        # a trigger arriving before the trigger systems are waiting for it is ignored
+        channel = channel or self.channel
+        tstart = time.perf_counter()
+        while True:
+            conditions = [int(float(c)) for c in self.query(f"STAT:OPER:COND? (@{channel})").split(",")]
+            if all(c & bits == bits for c in conditions):
+                return
+            if time.perf_counter() - tstart > self.wtg_timeout:
+                raise Exception(f"trigger system of channels {channel} not waiting for trigger")
+
+    def query(self, cmd):
+        # one write/read round trip on the bus
+        self.flush()
+        self.shadow_update(cmd)
+        self.port.write(cmd)
+        self.roundtrips += 1
+        return self.port.read()
+
+    # COMMAND QUEUE
+
+    def write(self, cmd):
+        # skip settings whose value has not changed since the last write
+        if self.shadow_unchanged(cmd):
+            return False
+        self.shadow_update(cmd)
+
+        # writes are buffered while the command queue is active
+        if self.queue_active:
+            self.queue.append(cmd)
+        else:
+            self.port.write(cmd)
+        return True
+
+    def start_queue(self):
+        self.queue_active = True
+
+    def stop_queue(self):
+        self.flush()
+        self.queue_active = False
+
+    def flush(self):
+        # queued commands are sent as few ';' joined messages within the byte limit
+        messages = []
+        for cmd in self.queue:
+            # absolute header path, otherwise it would be relative to the previous command
+            if not cmd.startswith(("*", ":")):
+                cmd = ":" + cmd
+            if messages and len(messages[-1]) + len(cmd) + 1 <= self.max_message_length:
+                messages[-1] += ";" + cmd
+            else:
+                messages.append(cmd)
+
+        for message in messages:
+            self.port.write(message)
+
+        self.transactions_saved += len(self.queue) - len(messages)
+        self.queue = []
+
+    # STATE SHADOW
+
+    def shadow_unchanged(self, cmd):
+        # only single commands are skipped, compound messages are always sent
+        if ";" in cmd:
+            return False
+        key, value = self.shadow_key(cmd)
+        return key is not None and self.shadow.get(key) == value
+
+    def shadow_update(self, cmd):
+        # every setting of a (compound) message is recorded
+        for part in cmd.split(";"):
+            # reset and recall invalidate the state shadow
+            if part.strip().startswith(("*RST", "*RCL")):
+                self.shadow = dict()
+                continue
+            key, value = self.shadow_key(part)
+            if key is not None:
+                # the same header with another channel list is no longer known
+                header = key.split(" (@")[0]
+                for other in [k for k in self.shadow if k.split(" (@")[0] == header]:
+                    del self.shadow[other]
+                self.shadow[key] = value
+
+    def shadow_key(self, cmd):
+        # settings are shadowed by header and channel list, e.g. 'VOLT 1, (@1)' -> 'VOLT (@1)': '1'
+        cmd = cmd.strip()
+        if cmd.startswith("*") or "?" in cmd or " " not in cmd:
+            return None, None
+        header, value = cmd.split(" ", 1)
+        header = header.lstrip(":").upper()
+        # actions like 'INIT:TRAN (@1)' have only a channel list
+        if value.startswith("(@") or header in self.shadow_exclude:
+            return None, None
+        if ", (@" in value:
+            value, channels = value.rsplit(", (@", 1)
+            header += " (@" + channels
+        return header, value.strip()
@@ -43,11 +43,21 @@
 # External (EXT)    offset/lolevel up to trigger, @trigger: 3 signal (6s), offset/lolevel (2s) - no repetitions, no delay
 # Bus	   (BUS)    signal (6s), offset/lolevel up to next sweep value (apply method)
 
+import os
+import json
+import time
+import math
+import hashlib
+import itertools
+from functools import lru_cache
+import numpy as np
 from EmptyDeviceClass import EmptyDevice
 from ErrorMessage import debug
 
 class Device(EmptyDevice):
 
+    actions = ["benchmark_apply"]
+
     def __init__(self):
     
     
@@ -119,21 +129,77 @@ class Device(EmptyDevice):
         self.waveforms['Arb'][self.FREQUENCY] = dict({"command": "FREQ", "unit": "Hz"})
         self.waveforms['Arb'][self.AMPLITUDE] = dict({"command": "VOLT", "unit": "V"})
         self.waveforms['Arb'][self.OFFSET] = dict({"command": "VOLT:OFFS", "unit": "V"})
-        self.waveforms['Arb'][self.SAMPLES] = dict({"command": "DATA VOLATILE, ", "unit": "samples"})
+        self.waveforms['Arb'][self.SAMPLES] = dict({"command": "DATA:DAC VOLATILE,", "unit": "samples"})
+
+        # arbitrary waveforms: 14-bit DAC codes, up to 64k points, 4 non-volatile user slots
+        self.dac_max = 8191
+        self.arb_max_points = 65536
+        self.arb_slots = 4
+        # non-volatile names made from the content hash, e.g. 'SW0123456789'
+        self.arb_prefix = "SW"
+        self.arb_catalog = None
+        self.arb_file_cache = None
+        # large waveform files are averaged in chunks of this many points
+        self.arb_chunk_points = 2**22
+        # text files are parsed in chunks of this many lines, only float32 values are kept
+        self.arb_chunk_lines = 2**18
+        self.arb_selected = None
+        # waveforms synthesized in the driver instead of being read from a file
+        self.arb_sources = ["File", "Chirp", "Multisine", "Pulse train", "PRBS", "Piecewise linear"]
+        # maximal length PRBS as s[i] = s[i - order] ^ s[i - lag]
+        self.prbs_lags = {7: 6, 9: 5, 11: 9, 15: 14}
+        # identical renders are reused, e.g. when a sweep returns to a previous waveform
+        self.render_arb = lru_cache(maxsize=32)(self.render_arb)
 
+        # complete setups are stored in the user state locations 1-4, named after a hash of the GUI parameters
+        self.setup_slots = [1, 2, 3, 4]
+        self.setup_prefix = "SM"
+        self.setup_names = None
+        # host time of the last use of each setup name, the least recently used location is overwritten
+        self.setup_usage_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), "setup_usage.json")
+
+        # 'params' are the waveform parameters that depend on the sweep value and are set at each point
         self.commands = {
-            self.FREQUENCY: {"command": "FREQ", "unit": "Hz"},
-            self.PERIOD: {"command": "FREQ", "unit": "s"}, 
-            self.AMPLITUDE: {"command": "VOLT", "unit": "V"}, 
-            self.OFFSET: {"command": "VOLT:OFFS", "unit": "V"}, 
-            self.HILEVEL: {"command": "VOLT", "unit": "V"},  
-            self.LOLEVEL: {"command": "VOLT:OFFS", "unit": "V"}, 
-            self.DUTYCYCLE: {"command": "FUNC:SQUARE:DCYCLE", "unit": "%"}, 
-            self.PULSEWIDTH: {"command": "PULSE:WIDTH", "unit": "s"}, 
-            self.RISETIME: {"command": "FUNC:RAMP:SYMMETRY", "unit": "%"}
+            self.FREQUENCY: {"command": "FREQ", "unit": "Hz", "params": [self.FREQUENCY, self.DUTYCYCLE, self.SYMMETRY, self.PULSEWIDTH]},
+            self.PERIOD: {"command": "FREQ", "unit": "s", "params": [self.FREQUENCY, self.DUTYCYCLE, self.SYMMETRY, self.PULSEWIDTH]}, 
+            self.AMPLITUDE: {"command": "VOLT", "unit": "V", "params": [self.AMPLITUDE, self.OFFSET]}, 
+            self.OFFSET: {"command": "VOLT:OFFS", "unit": "V", "params": [self.AMPLITUDE, self.OFFSET]}, 
+            self.HILEVEL: {"command": "VOLT", "unit": "V", "params": [self.AMPLITUDE, self.OFFSET]},  
+            self.LOLEVEL: {"command": "VOLT:OFFS", "unit": "V", "params": [self.AMPLITUDE, self.OFFSET]}, 
+            self.DUTYCYCLE: {"command": "FUNC:SQUARE:DCYCLE", "unit": "%", "params": [self.DUTYCYCLE, self.PULSEWIDTH]}, 
+            self.PULSEWIDTH: {"command": "PULSE:WIDTH", "unit": "s", "params": [self.DUTYCYCLE, self.PULSEWIDTH]}, 
+            self.RISETIME: {"command": "FUNC:RAMP:SYMMETRY", "unit": "%", "params": [self.SYMMETRY, self.RISETIME]}
         }
+        # APPLy resets duty cycle, symmetry and pulse shape, so it is used only for these waveforms
+        self.apply_waveforms = ('Sine', 'Noise', 'DC', 'Arb')
 
         self.shortname = 'Agilent-33220A'
+
+        # output state, APPLy switches the output on as well
+        self.output_on = False
+
+        # hardware frequency sweep: host time of output on and of the last sweep trigger
+        self.sweep_spacing = {"Linear": "LIN", "Logarithmic": "LOG"}
+        self.output_time = None
+        self.trigger_time = None
+
+        # command queue to send several writes as one message
+        self.queue = []
+        self.queue_active = False
+        self.max_message_length = 1024
+        self.transactions_saved = 0
+
+        # host time spent in apply() per sweep point
+        self.apply_times = []
+
+        # readback of the swept parameter, otherwise the last written value is returned
+        self.verify_policies = ["Always", "Every Nth point", "On error", "Never"]
+        self.point_count = 0
+        self.readback = False
+
+        # last value written per SCPI header, actions and output state are never skipped
+        self.shadow = dict()
+        self.shadow_exclude = ("OUTP", "OUTPUT", "DATA:DEL", "DATA:COPY") + tuple(f"APPL:{w['label']}" for w in self.waveforms.values())
         
         self.plottype = [True] # True to plot data
         self.savetype = [True] # True to save data
@@ -149,6 +215,7 @@ class Device(EmptyDevice):
         # UNIT:ANGLe?
 
     def get_GUIparameter(self, parameter={}):
+        self.setup_parameters            = dict(parameter)
         self.sweep_mode                  = parameter['SweepMode'] 
         self.waveform                    = parameter['Waveform'] 
         self.periodfrequency             = parameter['PeriodFrequency']
@@ -165,8 +232,20 @@ class Device(EmptyDevice):
         self.impedance                   = parameter['Impedance']
         self.trigger_mode                = parameter['Trigger']
         self.waveform_file               = parameter['ArbitraryWaveformFile']
+        self.arb_scaling                 = parameter['ArbitraryScaling']
+        self.arb_source                  = parameter['ArbitrarySource']
+        self.arb_definition              = parameter['ArbitraryDefinition']
+        self.arb_points                  = int(parameter['ArbitraryPoints'])
         self.burst_signals               = int(parameter['BurstSignalRepetitions'])
         self.burst_period                = float(parameter['BurstDelay'])
+        self.sweep_spacing_mode          = parameter['SweepSpacing']
+        self.sweep_start                 = float(parameter['SweepStartFrequency'])
+        self.sweep_stop                  = float(parameter['SweepStopFrequency'])
+        self.sweep_time                  = float(parameter['SweepTime'])
+        self.sweep_marker                = float(parameter['SweepMarkerFrequency'])
+        self.verify_policy               = parameter['Verification']
+        self.verify_interval             = max(1, int(parameter['VerificationInterval']))
+        self.setup_memory                = parameter['SetupMemory']
         
         if self.sweep_mode == 'None':
             self.variables =[]
@@ -179,6 +258,13 @@ class Device(EmptyDevice):
             self.plottype = [True]     # True to plot data
             self.savetype = [True]     # True to save data   
 
+        # host time of sweep start and marker, relative to output on
+        if self.operation_mode == "Sweep":
+            self.variables += ["Sweep start", "Sweep marker"]
+            self.units += ["s", "s"]
+            self.plottype += [True, True]
+            self.savetype += [True, True]
+
     def set_GUIparameter(self):
         GUIparameter = {
                         "SweepMode": [self.FREQUENCY, self.PERIOD, self.AMPLITUDE, self.OFFSET, self.HILEVEL, self.LOLEVEL, self.DUTYCYCLE, self.PULSEWIDTH, self.RISETIME, "None"],
@@ -194,108 +280,192 @@ class Device(EmptyDevice):
                         #"DelayPhaseValue": 0,
                         "DutyCyclePulseWidthValue": 1,
                         self.RISETIME: 1,
-                        "OperationMode": ["Continuous", "Burst"],
+                        "OperationMode": ["Continuous", "Burst", "Sweep"],
                         "Impedance": ["High-Z", "50 Ohm"],
                         "Trigger": ["Internal", "External", "Bus"], 
                         "ArbitraryWaveformFile": "",
+                        "ArbitraryScaling": ["Normalized", "File values in V"],
+                        "ArbitrarySource": self.arb_sources,
+                        "ArbitraryDefinition": "",
+                        "ArbitraryPoints": 4096,
                         "BurstShowHide": False,
                         "BurstSignalRepetitions": 1,
                         "BurstDelay": 60,
                         #"BurstRepetitions": 1,
+                        "SweepSpacing": list(self.sweep_spacing.keys()),
+                        "SweepStartFrequency": 100,
+                        "SweepStopFrequency": 1e3,
+                        "SweepTime": 1,
+                        "SweepMarkerFrequency": 500,
+                        "Verification": self.verify_policies,
+                        "VerificationInterval": 10,
+                        "SetupMemory": ["Off", "Save and recall"],
                         }
         return GUIparameter
         
     def initialize(self):
-        self.port.write("*RST")
+        self.queue = []
+        self.queue_active = False
+        self.transactions_saved = 0
+        self.apply_times = []
+        self.point_count = 0
+        self.shadow = dict()
+        self.arb_catalog = None
+        self.arb_selected = None
+        self.setup_names = None
+        self.output_on = False
+        self.output_time = None
+        self.trigger_time = None
+        self.write("*RST")
         # Autoranging the voltage port
-        self.port.write("VOLT:RANG:AUTO ON")
+        self.write("VOLT:RANG:AUTO ON")
         
     def configure(self):
-        if self.impedance == "High-Z":
-            self.port.write("OUTP:LOAD INF")
-        if self.impedance == "50 Ohm":
-            self.port.write("OUTP:LOAD 50")
+        self.start_queue()
+        try:
+            # a stored setup with the same GUI parameters replaces all following writes
+            if self.setup_memory == "Save and recall" and self.recall_setup():
+                return
 
-        if self.operation_mode == "Burst":
-            self.port.write("BURST:STATE ON")
-            self.port.write(f"BURST:NCYCLES {self.burst_signals}")
-            # burst delay > period * signal repetitions
-            self.port.write(f"BURST:INTERNAL:PERIOD {self.burst_period}")
+            if self.impedance == "High-Z":
+                self.write("OUTP:LOAD INF")
+            if self.impedance == "50 Ohm":
+                self.write("OUTP:LOAD 50")
 
-        if self.trigger_mode == "Internal":
-            self.port.write("TRIG:SOURCE IMM")
-        elif self.trigger_mode == "External":
-            self.port.write("TRIG:SOURCE EXT")
-        elif self.trigger_mode == "Bus":
-            self.port.write("TRIG:SOURCE BUS")
+            if self.operation_mode == "Burst":
+                self.write("BURST:STATE ON")
+                self.write(f"BURST:NCYCLES {self.burst_signals}")
+                # burst delay > period * signal repetitions
+                self.write(f"BURST:INTERNAL:PERIOD {self.burst_period}")
+
+            self.set_trigger_source()
         
-        if self.waveform == 'Sine':
-            self.set_sine_params()
-        elif self.waveform == 'Square':
-            self.set_square_params()
-        elif self.waveform == 'Ramp':
-            self.set_ramp_params()
-        elif self.waveform == 'Pulse':
-            self.set_pulse_params()
-        elif self.waveform == 'Noise':
-            self.set_noise_params()
-        elif self.waveform == 'DC':
-            self.set_dc_params()
-        elif self.waveform == 'Arb':
-            self.set_arb_params()
+            if self.waveform == 'Sine':
+                self.set_sine_params()
+            elif self.waveform == 'Square':
+                self.set_square_params()
+            elif self.waveform == 'Ramp':
+                self.set_ramp_params()
+            elif self.waveform == 'Pulse':
+                self.set_pulse_params()
+            elif self.waveform == 'Noise':
+                self.set_noise_params()
+            elif self.waveform == 'DC':
+                self.set_dc_params()
+            elif self.waveform == 'Arb':
+                self.set_arb_params()
+
+            if self.operation_mode == "Sweep":
+                self.set_sweep_params()
+
+            if self.setup_memory == "Save and recall":
+                self.save_setup()
+        finally:
+            self.stop_queue()
                         
     def deinitialize(self):
-        self.port.write("*RST")
-        self.port.write("SYST:LOC")
+        # final commands are sent directly, also if a phase has left commands queued
+        self.stop_queue()
+        self.write("*RST")
+        self.write("SYST:LOC")
+        debug(f"Agilent 33220A: {self.transactions_saved} bus transactions saved by command queue")
+        if self.apply_times:
+            debug(f"Agilent 33220A: apply latency mean {np.mean(self.apply_times) * 1e3:.2f} ms, "
+                  f"max {np.max(self.apply_times) * 1e3:.2f} ms over {len(self.apply_times)} points")
          
     def poweron(self):
         # arbitrary waveform FUNC must be set after data upload
         if self.waveform != 'Arb':
-            self.port.write(f"FUNC {self.waveforms[self.waveform]['label']}")
-        self.port.write("OUTP ON")
+            self.write(f"FUNC {self.waveforms[self.waveform]['label']}")
+        self.write("OUTP ON")
+        self.output_on = True
+        self.output_time = time.perf_counter()
+        if self.operation_mode == "Sweep":
+            # enabling the sweep with the output on (re)starts it, internal triggers repeat it from here
+            self.write("SWE:STAT ON")
+            self.output_time = time.perf_counter()
         
     def poweroff(self):
-        self.port.write("OUTP OFF")
+        self.stop_queue()
+        self.write("OUTP OFF")
+        self.output_on = False
+        if self.operation_mode == "Sweep":
+            self.write("SWE:STAT OFF")
+        self.output_time = None
 
     def set_parameter(self, param, value):
         if self.waveforms[self.waveform].get(param, False):
-            self.port.write(f"{self.waveforms[self.waveform][param]['command']} {value}; *WAI")
+            if self.write(f"{self.waveforms[self.waveform][param]['command']} {value}"):
+                self.write("*WAI")
             return True
         else: return False
                                  
     def apply(self):
         if self.sweep_mode != 'None':
-            self.update_sweep_params(self.value)                       
-            # reconfigure waveform
-            self.configure()
-            if self.trigger_mode == "Bus":
-                self.port.write("TRIG")
+            tstart = time.perf_counter()
+            self.start_queue()
+            try:
+                self.update_sweep_params(self.value)                       
+                # static settings are kept from configure, only the swept parameters are sent
+                self.apply_point()
+                # a hardware sweep is triggered in measure, also if nothing is swept
+                if self.trigger_mode == "Bus" and self.operation_mode != "Sweep":
+                    self.write("TRIG")
+            finally:
+                self.stop_queue()
+            self.apply_times.append(time.perf_counter() - tstart)
                        
     def measure(self):
+        if self.operation_mode == "Sweep" and self.trigger_mode == "Bus":
+            self.flush()
+            self.port.write("TRIG")
+            self.trigger_time = time.perf_counter()
+
         if self.sweep_mode != 'None':
-            self.port.write("%s?" % (self.commands[self.sweep_mode]['command']))
+            self.readback = self.needs_readback()
+            if self.readback:
+                self.flush()
+                self.port.write("%s?" % (self.commands[self.sweep_mode]['command']))
+            self.point_count += 1
             
     def call(self):
         if self.sweep_mode == 'None':
-            return []
+            values = []
         else:
-            self.realvalue = float(self.port.read())
+            if self.readback:
+                self.realvalue = float(self.port.read())
+            else:
+                # value of the last write, kept by the state shadow
+                self.realvalue = float(self.shadow[self.commands[self.sweep_mode]['command']])
             if self.sweep_mode == self.PERIOD:
-                return [1/self.realvalue]
+                values = [1/self.realvalue]
             elif self.sweep_mode == self.OFFSET:
-                return [self.realvalue]
+                values = [self.realvalue]
             elif self.sweep_mode == self.HILEVEL:
-                return [self.amplitudehilevelvalue]
+                values = [self.amplitudehilevelvalue]
             elif self.sweep_mode == self.LOLEVEL:
-                return [self.offsetlolevelvalue] 
+                values = [self.offsetlolevelvalue] 
             elif self.sweep_mode == self.RISETIME:
-                return [self.realvalue]
+                values = [self.realvalue]
             elif self.sweep_mode == self.DUTYCYCLE:
-                return [self.realvalue]
-            else: return [self.realvalue]
+                values = [self.realvalue]
+            else: values = [self.realvalue]
+
+        if self.operation_mode == "Sweep":
+            values += self.get_sweep_times()
+
+        return values
         
     # convenience functions
 
+    def set_trigger_source(self):
+        if self.trigger_mode == "Internal":
+            self.write("TRIG:SOURCE IMM")
+        elif self.trigger_mode == "External":
+            self.write("TRIG:SOURCE EXT")
+        elif self.trigger_mode == "Bus":
+            self.write("TRIG:SOURCE BUS")
+
     def update_sweep_params(self, value):
         if self.sweep_mode == self.PERIOD or self.sweep_mode == self.FREQUENCY:
             self.periodfrequencyvalue = value
@@ -308,6 +478,77 @@ class Device(EmptyDevice):
         elif self.sweep_mode == self.RISETIME:
             self.risetime = value
 
+    def apply_point(self):
+        params = getattr(self, f"get_{self.waveform.lower()}_params")()
+        names = [p for p in self.commands[self.sweep_mode]["params"] if p in params and p in self.waveforms[self.waveform]]
+
+        if self.operation_mode == "Continuous" and self.waveform in self.apply_waveforms:
+            # one APPLy write sets frequency, amplitude and offset together
+            apply_params = [self.FREQUENCY, self.AMPLITUDE, self.OFFSET]
+            if any(self.shadow.get(self.waveforms[self.waveform][p]['command']) != str(params[p]) for p in names):
+                self.write(f"APPL:{self.waveforms[self.waveform]['label']} {', '.join(str(params[p]) for p in apply_params)}")
+                for p in apply_params:
+                    self.shadow[self.waveforms[self.waveform][p]['command']] = str(params[p])
+                # APPLy also sets the immediate trigger source and switches the output on
+                self.shadow["TRIG:SOURCE"] = "IMM"
+                self.output_on = True
+                self.set_trigger_source()
+                self.write("*WAI")
+            return
+
+        if any([self.write(f"{self.waveforms[self.waveform][p]['command']} {params[p]}") for p in names]):
+            self.write("*WAI")
+
+    def needs_readback(self):
+        # HiLevel and LoLevel are returned from the set values, the readback is not used
+        if self.sweep_mode in (self.HILEVEL, self.LOLEVEL):
+            return False
+        # nothing to return without a written value, e.g. after *RST
+        if self.commands[self.sweep_mode]['command'] not in self.shadow:
+            return True
+
+        if self.verify_policy == "Always":
+            return True
+        elif self.verify_policy == "Every Nth point":
+            return self.point_count % self.verify_interval == 0
+        elif self.verify_policy == "On error":
+            error = self.query("SYST:ERR?")
+            if int(error.split(",")[0]) != 0:
+                debug(f"Agilent 33220A: {error.strip()}")
+                return True
+        return False
+
+    def benchmark_apply(self):
+        # compares a full configure with the per point phase, alternating between two sweep values
+        if self.sweep_mode == 'None':
+            raise Exception("Benchmark requires a sweep mode")
+        # APPLy of the per point phase would switch the output on
+        if not self.output_on:
+            raise Exception("Benchmark requires the output to be on")
+        value = self.value
+        values = [value, value * 1.01 if value else 0.01]
+
+        for label, step in [("full configure", self.configure), ("per point", self.apply_point)]:
+            repetitions = 20
+            tstart = time.perf_counter()
+            for i in range(repetitions):
+                self.start_queue()
+                try:
+                    self.update_sweep_params(values[i % 2])
+                    step()
+                finally:
+                    self.stop_queue()
+                self.query("*OPC?")
+            telapsed = (time.perf_counter() - tstart) / repetitions
+            debug(f"Agilent 33220A: {label} in {telapsed * 1e3:.2f} ms per point")
+
+        self.update_sweep_params(value)
+        self.start_queue()
+        try:
+            self.apply_point()
+        finally:
+            self.stop_queue()
+
     # SINE 
 
     def get_sine_params(self):
@@ -444,16 +685,433 @@ class Device(EmptyDevice):
     def get_arb_params(self):
         params = self.get_sine_params()
 
+        # file values are kept in volts by setting amplitude and offset of the normalized waveform
+        if self.arb_source == "File" and self.arb_scaling == "File values in V":
+            dac, amplitude, offset = self.load_arb_file(self.waveform_file)
+            params.update({self.AMPLITUDE: amplitude, self.OFFSET: offset})
+
         return params
 
     def set_arb_params(self):
         params = self.get_arb_params()
+        dac = self.get_arb_dac()
+
         self.set_parameter(self.FREQUENCY, params[self.FREQUENCY])
         self.set_parameter(self.AMPLITUDE, params[self.AMPLITUDE])
         self.set_parameter(self.OFFSET, params[self.OFFSET])
 
-        with open(self.waveform_file, 'r') as f:
-            self.set_parameter(self.SAMPLES, f.read())
+        self.select_arb(dac)
+        self.write(f"FUNC {self.waveforms[self.waveform]['label']}")
+
+    def get_arb_dac(self):
+        # DAC codes of the waveform file or of the synthesized waveform
+        if self.arb_source == "File":
+            dac, amplitude, offset = self.load_arb_file(self.waveform_file)
+            return dac
+        return self.to_dac(self.render_arb(self.arb_source, self.arb_definition, self.arb_points))
+
+    def load_arb_file(self, filename):
+        # read again only if the file or the scaling has changed
+        key = (filename, os.path.getmtime(filename), self.arb_scaling)
+        if self.arb_file_cache is None or self.arb_file_cache[:3] != key:
+            values = self.resample_arb(self.read_arb_file(filename))
+            if self.arb_scaling == "File values in V":
+                values, amplitude, offset = self.normalize_arb(values)
+            else:
+                # normalized files are already in -1..1 and are used as they are
+                amplitude, offset = None, None
+            self.arb_file_cache = key + ((self.to_dac(values), amplitude, offset),)
+        return self.arb_file_cache[3]
+
+    def read_arb_file(self, filename):
+        # .npy and raw float32 files are memory-mapped, text files are parsed by numpy
+        extension = os.path.splitext(filename)[1].lower()
+        if extension == ".npy":
+            values = np.load(filename, mmap_mode='r')
+        elif extension in (".bin", ".raw", ".f32"):
+            values = np.memmap(filename, dtype='<f4', mode='r')
+        else:
+            return self.read_arb_text(filename)
+
+        # the last column holds the values of tables with a time column
+        return values[:, -1] if values.ndim > 1 else values.ravel()
+
+    def read_arb_text(self, filename):
+        # comma or line separated values, or a csv table with optional header line
+        with open(filename, 'r') as f:
+            lines = [f.readline(), f.readline(), f.readline()]
+
+        header = 0
+        try:
+            [float(v) for v in lines[0].split(",") if v.strip()]
+        except ValueError:
+            header = 1
+
+        columns = [[i for i, v in enumerate(line.split(",")) if v.strip()] for line in lines[header:header + 2]]
+        if len(columns[0]) > 1 and len(columns[0]) != len(columns[1]) and (columns[1] or not header):
+            # free list of values, e.g. several values per line, a single line below a header is a table row
+            return self.read_arb_chunks(filename, header, None)
+
+        # table with the values in the last column, uneven rows are read as free list
+        try:
+            return self.read_arb_chunks(filename, header, columns[0][-1])
+        except (ValueError, IndexError):
+            return self.read_arb_chunks(filename, header, None)
+
+    def read_arb_chunks(self, filename, header, column):
+        # values of one table column, or all values in file order if column is None
+        chunks = []
+        with open(filename, 'r') as f:
+            if header:
+                f.readline()
+            while True:
+                lines = list(itertools.islice(f, self.arb_chunk_lines))
+                if not lines:
+                    break
+                if column is None:
+                    # line breaks count as separators
+                    values = [v for v in ",".join(lines).replace("\n", ",").split(",") if v.strip()]
+                    chunks.append(np.array(values, dtype=np.float32))
+                else:
+                    lines = [line for line in lines if line.strip()]
+                    if lines:
+                        chunks.append(np.loadtxt(lines, delimiter=",", usecols=column, dtype=np.float32, ndmin=1))
+        return np.concatenate(chunks) if chunks else np.empty(0, dtype=np.float32)
+
+    def resample_arb(self, values):
+        # block averaging as anti-aliasing filter, done in chunks so memory-mapped files are streamed
+        n = len(values)
+        if n <= self.arb_max_points:
+            return np.asarray(values, dtype=float)
+
+        q = -(-n // self.arb_max_points)
+        blocks = n // q
+        step = q * max(1, self.arb_chunk_points // q)
+        resampled = np.empty(blocks)
+        for start in range(0, blocks * q, step):
+            chunk = np.asarray(values[start:min(start + step, blocks * q)], dtype=float)
+            resampled[start // q:start // q + len(chunk) // q] = chunk.reshape(-1, q).mean(axis=1)
+        return resampled
+
+    def normalize_arb(self, values):
+        # values scaled to -1..1, amplitude (peak-to-peak) and offset restore the original scaling
+        low, high = float(np.min(values)), float(np.max(values))
+        amplitude = high - low
+        offset = (high + low) / 2
+        if amplitude == 0:
+            return np.zeros(len(values)), amplitude, offset
+        return (values - offset) * (2 / amplitude), amplitude, offset
+
+    # ARB SYNTHESIS
+
+    def render_arb(self, source, definition, points):
+        # one waveform period in -1..1, frequencies are given in cycles per period
+        params = self.parse_arb_definition(definition)
+        t = np.arange(points) / points
+
+        if source == "Chirp":
+            start, stop = params.get("start", 1), params.get("stop", 10)
+            if params.get("spacing", "lin") == "log":
+                if start <= 0 or stop <= 0:
+                    raise Exception("Logarithmic chirp requires positive start and stop frequencies")
+                k = np.log(stop / start)
+                if k == 0:
+                    values = np.sin(2 * np.pi * start * t)
+                else:
+                    values = np.sin(2 * np.pi * start * np.expm1(k * t) / k)
+            else:
+                values = np.sin(2 * np.pi * (start * t + (stop - start) * t**2 / 2))
+
+        elif source == "Multisine":
+            harmonics = np.atleast_1d(params.get("harmonics", 1))
+            amplitudes = np.broadcast_to(params.get("amplitudes", 1), harmonics.shape)
+            phases = np.broadcast_to(np.radians(params.get("phases", 0)), harmonics.shape)
+            values = (amplitudes[:, None] * np.sin(2 * np.pi * harmonics[:, None] * t + phases[:, None])).sum(axis=0)
+            if not np.max(np.abs(values)) > 1e-9 * np.sum(np.abs(amplitudes)):
+                raise Exception("Multisine amplitudes must not cancel out")
+            values = values / np.max(np.abs(values))
+
+        elif source == "Pulse train":
+            values = np.where((t * params.get("pulses", 1)) % 1 < params.get("duty", 0.5), 1.0, -1.0)
+
+        elif source == "PRBS":
+            order = int(params.get("order", 7))
+            if order not in self.prbs_lags:
+                raise Exception(f"PRBS order must be one of {list(self.prbs_lags.keys())}")
+            lag = self.prbs_lags[order]
+            bits = np.ones(2**order - 1 + order, dtype=np.uint8)
+            # each block only depends on bits at least 'lag' positions before
+            for i in range(order, len(bits), lag):
+                n = min(lag, len(bits) - i)
+                bits[i:i + n] = bits[i - order:i - order + n] ^ bits[i - lag:i - lag + n]
+            bits = bits[order:]
+            if points < len(bits):
+                raise Exception(f"PRBS{order} requires at least {len(bits)} points")
+            # bits are stretched to the requested points, their lengths differ by at most one point
+            values = (2.0 * bits - 1)[np.arange(points) * len(bits) // points]
+
+        elif source == "Piecewise linear":
+            times = np.atleast_1d(params.get("times", [0, 1]))
+            levels = np.atleast_1d(params.get("values", [-1, 1]))
+            values = np.interp(t * times[-1], times, levels)
+
+        else:
+            raise Exception(f"Unknown arbitrary waveform source {source}")
+
+        values.flags.writeable = False
+        return values
+
+    def parse_arb_definition(self, definition):
+        # e.g. 'harmonics=1 3 5, amplitudes=1 0.33 0.2' -> {'harmonics': array([1, 3, 5]), ...}
+        params = dict()
+        for item in definition.split(","):
+            if "=" not in item:
+                continue
+            key, value = item.split("=", 1)
+            try:
+                value = np.array(value.split(), dtype=float)
+                value = value[0] if len(value) == 1 else value
+            except ValueError:
+                value = value.strip().lower()
+            params[key.strip().lower()] = value
+        return params
+
+    def to_dac(self, values):
+        values = np.asarray(values, dtype=float).ravel()
+        if not 1 < len(values) <= self.arb_max_points:
+            raise Exception(f"arbitrary waveform must have 2 to {self.arb_max_points} points")
+        if not np.isfinite(values).all():
+            raise Exception("arbitrary waveform contains values that are not finite")
+        return np.round(np.clip(values, -1, 1) * self.dac_max).astype('<i2')
+
+    def select_arb(self, dac):
+        # waveforms are found by content hash in the non-volatile slots before uploading
+        name = self.get_arb_name(dac)
+
+        if name not in self.get_arb_catalog():
+            self.upload_dac(dac)
+
+            # a slot used by this driver is freed if all slots are used
+            if len(self.arb_catalog) >= self.arb_slots:
+                own = [n for n in self.arb_catalog if n.startswith(self.arb_prefix)]
+                if not own:
+                    self.write("FUNC:USER VOLATILE")
+                    self.arb_selected = "VOLATILE"
+                    return
+                self.write("FUNC:USER VOLATILE")
+                self.write(f"DATA:DEL {own[0]}")
+                self.arb_catalog.remove(own[0])
+
+            self.write(f"DATA:COPY {name}, VOLATILE")
+            self.arb_catalog.append(name)
+
+        self.write(f"FUNC:USER {name}")
+        self.arb_selected = name
+
+    def get_arb_name(self, dac):
+        return self.arb_prefix + hashlib.sha1(dac.tobytes()).hexdigest()[:10].upper()
+
+    def get_arb_catalog(self):
+        # names of the non-volatile waveforms, queried once per run
+        if self.arb_catalog is None:
+            self.arb_catalog = [n.strip().strip('"') for n in self.query("DATA:NVOL:CAT?").split(",") if n.strip().strip('"')]
+        return self.arb_catalog
+
+    def upload_dac(self, dac):
+        # binary block of little endian 16-bit DAC codes
+        self.write("FORM:BORD SWAP")
+        self.flush()
+        data = dac.tobytes()
+        header = f"DATA:DAC VOLATILE, #{len(str(len(data)))}{len(data)}".encode()
+        self.port.port.write_raw(header + data + b"\n")
+        self.shadow.pop("FUNC:USER", None)
+
+    # SWEEP
+
+    def set_sweep_params(self):
+        # frequency is swept by the instrument, so it cannot be the SweepMe! sweep value as well
+        if self.sweep_mode in (self.FREQUENCY, self.PERIOD):
+            raise Exception("Sweep operation mode cannot be used with frequency or period as sweep mode")
+        if self.waveform in ('Pulse', 'Noise', 'DC'):
+            raise Exception(f"Frequency sweep is not available for {self.waveform} waveform")
+        if self.sweep_start == self.sweep_stop:
+            raise Exception("Sweep start and stop frequency must be different")
+        if not min(self.sweep_start, self.sweep_stop) <= self.sweep_marker <= max(self.sweep_start, self.sweep_stop):
+            raise Exception("Sweep marker frequency must be within start and stop frequency")
+
+        self.write(f"SWE:SPAC {self.sweep_spacing[self.sweep_spacing_mode]}")
+        self.write(f"FREQ:STAR {self.sweep_start}")
+        self.write(f"FREQ:STOP {self.sweep_stop}")
+        self.write(f"SWE:TIME {self.sweep_time}")
+        # marker is the falling edge of the sync output when the marker frequency is reached
+        self.write(f"MARK:FREQ {self.sweep_marker}")
+        self.write("MARK ON")
+        # the sweep itself is enabled at power on
+
+    def get_sweep_marker_delay(self):
+        # time from sweep start to marker frequency
+        if self.sweep_spacing_mode == "Logarithmic":
+            return self.sweep_time * math.log(self.sweep_marker / self.sweep_start) / math.log(self.sweep_stop / self.sweep_start)
+        return self.sweep_time * (self.sweep_marker - self.sweep_start) / (self.sweep_stop - self.sweep_start)
+
+    def get_sweep_times(self):
+        # start of the last sweep, internal triggers repeat the sweep from its start at power on
+        if self.trigger_mode == "Bus" and self.trigger_time is not None and self.output_time is not None:
+            start = self.trigger_time - self.output_time
+        elif self.trigger_mode == "Internal" and self.output_time is not None:
+            start = (time.perf_counter() - self.output_time) // self.sweep_time * self.sweep_time
+        else:
+            # external triggers are not seen by the host
+            return [float('nan'), float('nan')]
+        return [start, start + self.get_sweep_marker_delay()]
+
+    # SETUP MEMORY
+
+    def get_setup_name(self):
+        # state names have up to 12 characters and must start with a letter
+        setup = repr(sorted(self.setup_parameters.items()))
+        if self.waveform == 'Arb' and self.arb_source == "File":
+            setup += str(os.path.getmtime(self.waveform_file))
+        return self.setup_prefix + hashlib.sha1(setup.encode()).hexdigest()[:10].upper()
+
+    def get_setup_names(self):
+        # names of all user state locations in one query
+        if self.setup_names is None:
+            names = self.query(";:".join(f"MEM:STAT:NAME? {slot}" for slot in self.setup_slots)).split(";")
+            self.setup_names = dict(zip(self.setup_slots, [n.strip().strip('"') for n in names]))
+        return self.setup_names
+
+    def recall_setup(self):
+        name = self.get_setup_name()
+        for slot, slot_name in self.get_setup_names().items():
+            if slot_name == name:
+                # a stored state refers to its waveform by name, which may have been deleted since
+                if self.waveform == 'Arb':
+                    arb_name = self.get_arb_name(self.get_arb_dac())
+                    if arb_name not in self.get_arb_catalog():
+                        debug(f"Agilent 33220A: waveform {arb_name} of setup {name} not found, setup is written again")
+                        return False
+                    self.arb_selected = arb_name
+                # recall clears the state shadow, so parameters are written again when changed
+                self.write(f"*RCL {slot}")
+                self.use_setup(name)
+                debug(f"Agilent 33220A: setup {name} recalled from state {slot}")
+                return True
+        return False
+
+    def save_setup(self):
+        # the waveform of the volatile memory is not part of a stored state
+        if self.waveform == 'Arb' and self.arb_selected == "VOLATILE":
+            return
+
+        names = self.get_setup_names()
+        name = self.get_setup_name()
+        usage = self.load_setup_usage()
+        # an outdated location of the same setup, unnamed locations, then the least recently used one of this driver
+        same = [slot for slot, n in names.items() if n == name]
+        free = [slot for slot, n in names.items() if n in ("", f"STATE_{slot}")]
+        own = sorted([slot for slot, n in names.items() if n.startswith(self.setup_prefix)], key=lambda slot: usage.get(names[slot], 0))
+        if not same + free + own:
+            debug("Agilent 33220A: no state location available to store the setup")
+            return
+
+        slot = (same + free + own)[0]
+        self.write(f"*SAV {slot}")
+        self.write(f"MEM:STAT:NAME {slot},{name}")
+        names[slot] = name
+        self.use_setup(name)
+
+    def load_setup_usage(self):
+        if os.path.isfile(self.setup_usage_file):
+            try:
+                with open(self.setup_usage_file, 'r') as f:
+                    return json.load(f)
+            except (OSError, ValueError):
+                pass
+        return dict()
+
+    def use_setup(self, name):
+        usage = self.load_setup_usage()
+        usage[name] = time.time()
+        try:
+            with open(self.setup_usage_file, 'w') as f:
+                json.dump(usage, f, indent=2)
+        except OSError as e:
+            debug(f"Agilent 33220A: unable to save setup usage ({e})")
+
+    # COMMAND QUEUE
+
+    def write(self, cmd):
+        # skip settings whose value has not changed since the last write
+        if self.shadow_unchanged(cmd):
+            return False
+        self.shadow_update(cmd)
+
+        # writes are buffered while the command queue is active
+        if self.queue_active:
+            self.queue.append(cmd)
+        else:
+            self.port.write(cmd)
+        return True
+
+    def query(self, cmd):
+        self.flush()
+        self.shadow_update(cmd)
+        self.port.write(cmd)
+        return self.port.read()
+
+    def start_queue(self):
+        self.queue_active = True
+
+    def stop_queue(self):
+        self.flush()
+        self.queue_active = False
+
+    def flush(self):
+        # queued commands are sent as few ';' joined messages within the byte limit
+        messages = []
+        for cmd in self.queue:
+            # absolute header path, otherwise it would be relative to the previous command
+            if not cmd.startswith(("*", ":")):
+                cmd = ":" + cmd
+            if messages and len(messages[-1]) + len(cmd) + 1 <= self.max_message_length:
+                messages[-1] += ";" + cmd
+            else:
+                messages.append(cmd)
+
+        for message in messages:
+            self.port.write(message)
+
+        self.transactions_saved += len(self.queue) - len(messages)
+        self.queue = []
+
+    # STATE SHADOW
+
+    def shadow_unchanged(self, cmd):
+        # only single commands are skipped, compound messages are always sent
+        if ";" in cmd:
+            return False
+        key, value = self.shadow_key(cmd)
+        return key is not None and self.shadow.get(key) == value
+
+    def shadow_update(self, cmd):
+        # every setting of a (compound) message is recorded
+        for part in cmd.split(";"):
+            # reset and recall invalidate the state shadow
+            if part.strip().startswith(("*RST", "*RCL")):
+                self.shadow = dict()
+                continue
+            key, value = self.shadow_key(part)
+            if key is not None:
+                self.shadow[key] = value
 
-        self.port.write("FUNC:USER VOLATILE")
-        self.port.write(f"FUNC {self.waveforms[self.waveform]['label']}")
+    def shadow_key(self, cmd):
+        # settings are shadowed by header, e.g. 'VOLT:OFFS 0.5' -> 'VOLT:OFFS': '0.5'
+        cmd = cmd.strip()
+        if cmd.startswith("*") or "?" in cmd or " " not in cmd:
+            return None, None
+        header, value = cmd.split(" ", 1)
+        header = header.lstrip(":").upper()
+        if header in self.shadow_exclude:
+            return None, None
+        return header, value.strip()
@@ -29,6 +29,11 @@
 # Type: Signal
 # Device: Keysight N6705
 
+import copy
+import math
+import time
+import hashlib
+import numpy as np
 from EmptyDeviceClass import EmptyDevice
 from ErrorMessage import debug
 
@@ -64,6 +69,20 @@ class Device(EmptyDevice):
         self.TCONSTANT = "Time constant"
         #
         self.ENDTIME = "End time in s"          # not available on GUI
+        self.DWELL = "Dwell time in s"          # not available on GUI
+        self.LEVELS = "Levels in V"             # not available on GUI
+
+        # operation status bits of trigger systems waiting for a trigger (WTG-meas, WTG-tran)
+        self.wtg_meas = 1 << 3
+        self.wtg_tran = 1 << 5
+        self.wtg_timeout = 5
+
+        # max number of points of a constant dwell waveform
+        self.cdw_max_points = 65535
+        # user defined waveform and content hash of the waveform uploaded to each channel
+        self.user_waveform = None
+        self.user_waveform_file = None
+        self.uploaded_waveforms = dict()
 
         self.waveforms = dict()
         # Sine
@@ -121,12 +140,16 @@ class Device(EmptyDevice):
         self.waveforms['Exponential'][self.RISETIME] = dict({"command": "TIME", "unit": "s"})
         self.waveforms['Exponential'][self.TCONSTANT] = dict({"command": "TCONSTANT", "unit": "s"})
         self.waveforms['Exponential'][self.HILEVEL] = dict({"command": "END:LEVEL", "unit": "V"})
+        # User defined (constant dwell)
+        self.waveforms['User defined'] = dict()
+        self.waveforms['User defined']['label'] = "CDW"
+        self.waveforms['User defined'][self.DWELL] = dict({"command": "DWELL", "unit": "s"})
 
     def set_GUIparameter(self):
         GUIparameter = {
             "SweepMode": [self.PERIOD, self.FREQUENCY, self.AMPLITUDE, self.HILEVEL, self.OFFSET,  self.LOLEVEL, self.PHASE, \
                 self.DELAY, self.DUTYCYCLE, self.PULSEWIDTH, self.RISETIME, self.FALLTIME, self.NSTEPS,  self.TCONSTANT, "None"],
-            "Channel": ["1", "2", "3", "4"],
+            "Channel": ["1", "2", "3", "4", "1:2", "3:4", "1:4"],
             "Waveform": list(self.waveforms.keys()),
             "PeriodFrequency": [self.PERIOD, self.FREQUENCY],
             "AmplitudeHiLevel": [self.AMPLITUDE, self.HILEVEL],
@@ -139,7 +162,11 @@ class Device(EmptyDevice):
             "DelayPhaseValue": 10,
             "DutyCyclePulseWidthValue": 5,
             self.RISETIME: 1,
-            self.FALLTIME: 1
+            self.FALLTIME: 1,
+            "SweepValues": "",
+            "WaveformFile": "",
+            "Acquisition": ["Measure", "Fetch", "Capture"],
+            "CapturePoints": 4096,
         }
 
         return GUIparameter
@@ -160,21 +187,59 @@ class Device(EmptyDevice):
         self.dutycyclepulsewidthvalue = float(parameter['DutyCyclePulseWidthValue'])
         self.risetime                 = float(parameter['RiseTime'])
         self.falltime                 = float(parameter['FallTime'])
+        # sweep values for the planner, comma separated
+        self.sweep_values             = [float(v) for v in str(parameter.get('SweepValues', "")).split(",") if v.strip()]
+        # levels of the user defined waveform (.npy, .csv or text file)
+        self.waveform_file            = parameter.get('WaveformFile', "")
+        # 'Fetch' reads voltage and current of one acquisition armed in measure()
+        self.acquisition              = parameter.get('Acquisition', "Measure")
+        # 'Capture' digitizes one waveform period started by the ARB
+        self.capture_points           = int(parameter.get('CapturePoints', 4096))
 
         self.device = parameter['Device']
+        # single channel or SCPI channel range (e.g. '1:4') started by one trigger
         self.channel = parameter['Channel']
         self.shortname = "Keysight N6705 CH" + self.channel
+        if ":" in self.channel:
+            first, last = self.channel.split(":")
+            self.channels = [str(ch) for ch in range(int(first), int(last) + 1)]
+        else:
+            self.channels = [self.channel]
 
-        self.variables = ['Voltage in V', 'Current in A']
-        self.units = ['V', 'A']
-        self.plottype = [True, True]
-        self.savetype = [True, True]
+        if len(self.channels) > 1:
+            self.variables = [f'Voltage in V CH{ch}' for ch in self.channels] + [f'Current in A CH{ch}' for ch in self.channels]
+            self.units = ['V'] * len(self.channels) + ['A'] * len(self.channels)
+            self.variables.append('Start skew in s')
+            self.units.append('s')
+        else:
+            self.variables = ['Voltage in V', 'Current in A']
+            self.units = ['V', 'A']
+
+        if self.acquisition == "Capture":
+            self.variables.append('Time in s')
+            self.units.append('s')
+            for name in ['Voltage trace in V', 'Voltage min in V', 'Voltage max in V', 'Voltage rms in V']:
+                if len(self.channels) > 1:
+                    self.variables += [f'{name} CH{ch}' for ch in self.channels]
+                else:
+                    self.variables.append(name)
+                self.units += ['V'] * len(self.channels)
+
+        self.plottype = [True] * len(self.variables)
+        self.savetype = [True] * len(self.variables)
         
     def initialize(self):
         self.port.port.read_termination = '\n'
         self.port.port.write_termination = '\n'
         # once at the beginning of the measurement
         self.port.write("*RST")
+        # ARB parameters known to be set on the instrument
+        self.sent_params = dict()
+        self.pending = []
+        self.uploaded_waveforms = dict()
+        self.capture_settings = None
+        # arrays as IEEE-488.2 definite length blocks of little endian 32-bit floats
+        self.port.write("FORM:DATA REAL;:FORM:BORD SWAP")
 
     def deinitialize(self):
         pass
@@ -186,9 +251,25 @@ class Device(EmptyDevice):
         self.port.write(f"ARB:FUNC:SHAPE {self.waveforms[self.waveform]['label']}, (@{self.channel})")
         # TODO: number of signal repetitions
         self.port.write(f"ARB:COUNT INF, (@{self.channel})")
-        self.port.write(f"TRIG:ARB:SOURCE IMM")
-        self.port.write(f"OUTP ON, (@{self.channel})")
-        self.port.write(f"INIT:TRAN (@{self.channel})")
+        if self.acquisition in ("Fetch", "Capture"):
+            # voltage and current digitized together, only N676x and N678x modules measure both at once
+            self.port.write(f"SYST:CHAN:MODEL? (@{self.channel})")
+            models = [m.strip() for m in self.port.read().split(",")]
+            for ch, model in zip(self.channels, models):
+                if not model.startswith(('N676', 'N678')):
+                    raise Exception(f"{self.acquisition} acquisition not supported by channel {ch} ({model}), "
+                                    f"simultaneous voltage and current measurement requires N676x or N678x modules")
+            self.port.write(f"SENSE:FUNC:VOLT ON, (@{self.channel})")
+            self.port.write(f"SENSE:FUNC:CURR ON, (@{self.channel})")
+        if len(self.channels) > 1:
+            # all channels wait for the same bus trigger
+            self.port.write(f"TRIG:ARB:SOURCE BUS")
+            self.port.write(f"OUTP ON, (@{self.channel})")
+            self.start_skew = self.measure_start_skew()
+        else:
+            self.port.write(f"TRIG:ARB:SOURCE IMM")
+            self.port.write(f"OUTP ON, (@{self.channel})")
+            self.port.write(f"INIT:TRAN (@{self.channel})")
 
     def poweroff(self):
         self.port.write(f"OUTP OFF, (@{self.channel})")
@@ -197,11 +278,26 @@ class Device(EmptyDevice):
     def set_parameter(self, param, value):
         arb_prefix = f"ARB:VOLTAGE:{self.waveforms[self.waveform]['label']}"
         if self.waveforms[self.waveform].get(param, False):
-            self.port.write(f"{arb_prefix}:{self.waveforms[self.waveform][param]['command']} {value}, (@{self.channel}); *WAI")
+            # only changed parameters are queued and sent by send_pending()
+            if self.sent_params.get(param) != value:
+                self.pending.append(f"{arb_prefix}:{self.waveforms[self.waveform][param]['command']} {value}, (@{self.channel})")
+                self.sent_params[param] = value
             return True
         else: return False
 
+    def send_pending(self):
+        # queued commands in one message with a single completion sync
+        if self.pending:
+            self.port.write(self.join_commands(self.pending + ["*OPC?"]))
+            self.port.read()
+            self.pending = []
+
     def configure(self):
+        self.set_waveform_params()
+        self.send_pending()
+        self.plan_sweep()
+
+    def set_waveform_params(self):
         if self.waveform == 'Sine':
             self.set_sine_params()
         elif self.waveform == 'Step':
@@ -216,33 +312,220 @@ class Device(EmptyDevice):
             self.set_trapezoid_params()
         elif self.waveform == 'Exponential':
             self.set_exponential_params()
+        elif self.waveform == 'User defined':
+            self.set_user_params()
             
     def apply(self):
         if self.sweep_mode == 'None':
             pass
+        elif self.plan_valid and self.plan_index < len(self.plan) and float(self.value) == self.plan[self.plan_index]["value"]:
+            # pre-rendered message of the planned point
+            point = self.plan[self.plan_index]
+            self.plan_index += 1
+            if point["message"]:
+                self.port.write(point["message"])
+                self.port.read()
+                self.trigger_transient()
+            self.sent_params.update(point["params"])
         else:
+            self.plan_valid = False
             self.update_sweep_params(self.value)
-            self.port.write(f"ABORT:TRAN (@{self.channel}); *WAI")  # wait for pending abort                       
-            self.configure()                                        # reconfigure waveform
-            self.port.write(f"INIT:TRAN (@{self.channel})")
+            self.set_waveform_params()
+            # abort and re-init only if any ARB parameter has changed
+            if self.pending:
+                self.pending = [f"ABORT:TRAN (@{self.channel})"] + self.pending + self.arm_commands()
+                self.send_pending()
+                self.trigger_transient()
 
     def trigger(self):
         pass
 
     def measure(self):
-        # default read voltage and current
-        self.port.write(f"MEAS:VOLT? (@{self.channel})")
-        self.port.write(f"MEAS:CURR? (@{self.channel})")
+        if self.acquisition == "Fetch":
+            # acquisition runs while the host keeps working, results are fetched in call()
+            self.port.write(f"INIT:ACQ (@{self.channel})")
+            self.wait_for_trigger(self.wtg_meas)
+            self.port.write(f"TRIG:ACQ (@{self.channel})")
+        elif self.acquisition == "Capture":
+            self.arm_capture()
+        else:
+            # default read voltage and current
+            self.port.write(f"MEAS:VOLT? (@{self.channel})")
+            self.port.write(f"MEAS:CURR? (@{self.channel})")
 
     def call(self):
         retarr = []
-        retarr.append(float(self.port.read()))      # voltage
-        retarr.append(float(self.port.read()))      # current
-        
+        if self.acquisition == "Capture":
+            return self.read_capture()
+        elif self.acquisition == "Fetch":
+            # voltage and current of the same acquisition in one read
+            self.port.write(f"FETCH:VOLT? (@{self.channel});:FETCH:CURR? (@{self.channel})")
+            voltages, currents = self.port.read().split(";")
+            retarr += [float(v) for v in voltages.split(",")]
+            retarr += [float(i) for i in currents.split(",")]
+        else:
+            retarr += [float(v) for v in self.port.read().split(",")]      # voltage
+            retarr += [float(i) for i in self.port.read().split(",")]      # current
+
+        if len(self.channels) > 1:
+            retarr.append(self.start_skew)
+
         return retarr
 
     # convenience functions
 
+    def join_commands(self, commands):
+        # one message, headers are absolute except for common commands
+        return ";".join(c if c.startswith(("*", ":")) or i == 0 else ":" + c for i, c in enumerate(commands))
+
+    def arm_commands(self):
+        # channel lists are started afterwards by trigger_transient()
+        return [f"INIT:TRAN (@{self.channel})"]
+
+    def trigger_transient(self):
+        # channel lists are started together by a bus trigger once all ARBs are waiting for it
+        if len(self.channels) > 1:
+            self.wait_for_trigger(self.wtg_tran)
+            self.port.write("*TRG")
+
+    def wait_for_trigger(self, bits):
+        # a trigger arriving before the trigger systems are waiting for it is ignored
+        tstart = time.perf_counter()
+        while True:
+            self.port.write(f"STAT:OPER:COND? (@{self.channel})")
+            conditions = [int(float(c)) for c in self.port.read().split(",")]
+            if all(c & bits == bits for c in conditions):
+                return
+            if time.perf_counter() - tstart > self.wtg_timeout:
+                raise Exception(f"trigger system of channels {self.channel} not waiting for trigger")
+
+    def get_waveform_period(self):
+        # period of the current waveform parameters, None for waveforms without a period
+        params = self.get_waveform_params()
+        if self.PERIOD in params:
+            return params[self.PERIOD]
+        elif self.FREQUENCY in params:
+            return 1 / params[self.FREQUENCY]
+        return None
+
+    def arm_capture(self):
+        # digitizer covers one waveform period, interval is a multiple of 20.48 µs
+        period = self.get_waveform_period() or self.capture_points * 20.48e-6
+
+        tint = math.ceil(period / self.capture_points / 20.48e-6) * 20.48e-6
+        npoints = math.ceil(period / tint)
+        if (tint, npoints) != self.capture_settings:
+            self.port.write(f"SENSE:SWEEP:TINT {tint}, (@{self.channel})")
+            self.port.write(f"SENSE:SWEEP:POINTS {npoints}, (@{self.channel})")
+            self.port.write(f"TRIG:ACQ:SOURCE TRAN{self.channels[0]}")
+            self.capture_settings = (tint, npoints)
+
+        # waveform restarts and triggers the acquisition, which must already be waiting for it
+        self.port.write(f"INIT:ACQ (@{self.channel})")
+        self.wait_for_trigger(self.wtg_meas)
+        self.port.write(self.join_commands([f"ABORT:TRAN (@{self.channel})"] + self.arm_commands()))
+        self.trigger_transient()
+
+    def read_capture(self):
+        tint, npoints = self.capture_settings
+
+        traces = []
+        currents = []
+        for ch in self.channels:
+            voltage, current = [self.to_array(field) for field in self.query_fields(f"FETCH:ARR:VOLT? (@{ch});:FETCH:ARR:CURR? (@{ch})")]
+            traces.append(voltage.astype(np.float32, copy=False))
+            currents.append(float(current.mean()))
+
+        retarr = [float(trace.mean()) for trace in traces] + currents
+        if len(self.channels) > 1:
+            retarr.append(self.start_skew)
+
+        retarr.append(np.arange(len(traces[0]), dtype=np.float32) * np.float32(tint))
+        retarr += traces
+        retarr += [float(trace.min()) for trace in traces]
+        retarr += [float(trace.max()) for trace in traces]
+        retarr += [float(np.sqrt(np.mean(np.square(trace, dtype=np.float64)))) for trace in traces]
+
+        return retarr
+
+    def measure_start_skew(self):
+        # digitizer settings of the measurements are restored after the skew capture
+        saved_tint, saved_points = self.query_fields(f"SENSE:SWEEP:TINT? (@{self.channels[0]});:SENSE:SWEEP:POINTS? (@{self.channels[0]})")
+
+        # digitizers of all channels start with the same bus trigger as the ARBs
+        npoints = 4096
+        tint = max(20.48e-6, (self.get_waveform_period() or 0) / npoints)
+        self.port.write(f"SENSE:SWEEP:TINT {tint}, (@{self.channel})")
+        self.port.write(f"SENSE:SWEEP:POINTS {npoints}, (@{self.channel})")
+        self.port.write("TRIG:ACQ:SOURCE BUS")
+        self.port.write(self.join_commands([f"INIT:TRAN (@{self.channel})", f"INIT:ACQ (@{self.channel})"]))
+        self.wait_for_trigger(self.wtg_tran | self.wtg_meas)
+        self.port.write("*TRG")
+
+        tint = float(self.query_fields(f"SENSE:SWEEP:TINT? (@{self.channels[0]})")[0])
+        fields = [self.to_array(self.query_fields(f"FETCH:ARR:VOLT? (@{ch})")[0]) for ch in self.channels]
+
+        self.port.write(f"SENSE:SWEEP:TINT {saved_tint}, (@{self.channel})")
+        self.port.write(f"SENSE:SWEEP:POINTS {int(float(saved_points))}, (@{self.channel})")
+        # capture settings incl. the acquisition trigger source are rewritten at the next capture
+        self.capture_settings = None
+
+        # first sample leaving the initial level by more than 10 % of the waveform span
+        onsets = []
+        for data in fields:
+            deviation = np.abs(data - data[0])
+            if deviation.max() > 0:
+                onsets.append(np.argmax(deviation > 0.1 * deviation.max()))
+
+        if len(onsets) < 2:
+            return float('nan')
+
+        start_skew = (max(onsets) - min(onsets)) * tint
+        debug(f"Keysight N6705: start skew of channels {self.channel} is {start_skew} s")
+
+        return start_skew
+
+    def query_fields(self, cmd):
+        # answers of a (combined) query, arrays are kept as binary blocks
+        self.port.write(cmd)
+
+        # binary blocks may contain the termination character, read up to END
+        termination = self.port.port.read_termination
+        self.port.port.read_termination = None
+        try:
+            raw = self.port.port.read_raw()
+        finally:
+            self.port.port.read_termination = termination
+
+        return self.parse_fields(raw)
+
+    def parse_fields(self, raw):
+        # split a response into fields, definite length blocks become numpy views of the raw buffer
+        fields = []
+        pos = 0
+        while pos < len(raw):
+            if raw[pos:pos + 1] == b"#":
+                ndigits = int(raw[pos + 1:pos + 2])
+                nbytes = int(raw[pos + 2:pos + 2 + ndigits])
+                start = pos + 2 + ndigits
+                fields.append(np.frombuffer(raw, dtype='<f4', count=nbytes // 4, offset=start))
+                pos = start + nbytes
+            else:
+                end = raw.find(b";", pos)
+                if end < 0:
+                    end = len(raw)
+                fields.append(raw[pos:end].decode().strip())
+                pos = end
+            # skip separator and termination
+            while pos < len(raw) and raw[pos:pos + 1] in (b";", b"\n", b"\r"):
+                pos += 1
+        return fields
+
+    def to_array(self, field):
+        if isinstance(field, np.ndarray):
+            return field
+        return np.array(field.split(","), dtype=float)
+
     def update_sweep_params(self, value):
         if self.sweep_mode == self.PERIOD or self.sweep_mode == self.FREQUENCY:
             self.periodfrequencyvalue = value
@@ -263,6 +546,71 @@ class Device(EmptyDevice):
         elif self.sweep_mode == self.TCONSTANT:
             None    # fixme
 
+    # SWEEP PLAN
+
+    def get_waveform_params(self):
+        if self.waveform == 'Sine':
+            return self.get_sine_params()
+        elif self.waveform == 'Step':
+            return self.get_step_params()
+        elif self.waveform == 'Ramp':
+            return self.get_ramp_params()
+        elif self.waveform == 'Staircase':
+            return self.get_staircase_params()
+        elif self.waveform == 'Pulse':
+            return self.get_pulse_params()
+        elif self.waveform == 'Trapezoid':
+            return self.get_trapezoid_params()
+        elif self.waveform == 'Exponential':
+            return self.get_exponential_params()
+        elif self.waveform == 'User defined':
+            return self.get_user_params()
+
+    def plan_sweep(self):
+        # all sweep points are evaluated at once and rendered to messages before output is enabled
+        self.plan = []
+        self.plan_index = 0
+        # user defined waveforms are uploaded as arrays and are not planned
+        self.plan_valid = self.sweep_mode != 'None' and len(self.sweep_values) > 0 and self.waveform != 'User defined'
+        if not self.plan_valid:
+            return
+
+        values = np.array(self.sweep_values, dtype=float)
+
+        # the get_*_params helpers work on arrays as well as on scalars, they are evaluated
+        # on a copy so that period, levels and times of the device stay scalars
+        planner = copy.copy(self)
+        planner.update_sweep_params(values)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            params = planner.get_waveform_params()
+
+        params = {param: np.broadcast_to(np.asarray(value, dtype=float), values.shape) for param, value in params.items()}
+
+        # times must not be negative, period and frequency must be positive
+        invalid = np.zeros(values.shape, dtype=bool)
+        for param, value in params.items():
+            invalid |= ~np.isfinite(value)
+            if param in (self.DELAY, self.RISETIME, self.FALLTIME, self.PULSEWIDTH, self.ENDTIME, self.TCONSTANT):
+                invalid |= value < 0
+            elif param in (self.PERIOD, self.FREQUENCY):
+                invalid |= value <= 0
+        if invalid.any():
+            raise Exception(f"{self.waveform} waveform not possible for sweep values {values[invalid].tolist()}")
+
+        arb_prefix = f"ARB:VOLTAGE:{self.waveforms[self.waveform]['label']}"
+        commanded = [param for param in params if self.waveforms[self.waveform].get(param, False)]
+        previous = dict(self.sent_params)
+
+        for i, value in enumerate(values):
+            point = {param: float(params[param][i]) for param in commanded}
+            changed = [f"{arb_prefix}:{self.waveforms[self.waveform][param]['command']} {point[param]}, (@{self.channel})"
+                       for param in commanded if previous.get(param) != point[param]]
+            message = None
+            if changed:
+                message = self.join_commands([f"ABORT:TRAN (@{self.channel})"] + changed + self.arm_commands() + ["*OPC?"])
+            self.plan.append({"value": float(value), "params": point, "message": message})
+            previous.update(point)
+
     # STEP
 
     def get_step_params(self):
@@ -291,13 +639,13 @@ class Device(EmptyDevice):
         if self.periodfrequency == self.PERIOD:
             self.period = self.periodfrequencyvalue
         else:
-            self.period = float(1/self.periodfrequencyvalue)
+            self.period = 1 / self.periodfrequencyvalue
 
         if self.delayphase == self.DELAY:
             self.delay = self.delayphasevalue
         else:
             # delay = period * phase / 360
-            self.delay = float(self.period * self.delayphasevalue / 360)
+            self.delay = self.period * self.delayphasevalue / 360
 
         # lolevel and offset have same meaning
         self.lolevel = self.offsetlolevelvalue
@@ -442,3 +790,55 @@ class Device(EmptyDevice):
         self.set_parameter(self.RISETIME, params[self.RISETIME])
         self.set_parameter(self.HILEVEL, params[self.HILEVEL])
         self.set_parameter(self.TCONSTANT, params[self.TCONSTANT])
+
+    # USER DEFINED
+
+    def set_user_waveform(self, levels):
+        # normalized waveform, scaled by amplitude and shifted by offset at output
+        levels = np.asarray(levels, dtype=float).ravel()
+        if not 0 < len(levels) <= self.cdw_max_points:
+            raise Exception(f"user defined waveform must have 1 to {self.cdw_max_points} points")
+        self.user_waveform = levels
+
+    def load_user_waveform(self, filename):
+        if filename.lower().endswith('.npy'):
+            levels = np.load(filename)
+        else:
+            with open(filename, 'r') as f:
+                delimiter = ',' if ',' in f.readline() else None
+            levels = np.loadtxt(filename, delimiter=delimiter, ndmin=2)[:, -1]
+        self.set_user_waveform(levels)
+        self.user_waveform_file = filename
+
+    def get_user_params(self):
+        if self.waveform_file and self.waveform_file != self.user_waveform_file:
+            self.load_user_waveform(self.waveform_file)
+        if self.user_waveform is None:
+            raise Exception("no user defined waveform given")
+
+        if self.periodfrequency == self.PERIOD:
+            self.period = self.periodfrequencyvalue
+        else:
+            self.period = 1 / self.periodfrequencyvalue
+
+        # one period spans the whole waveform
+        self.dwell = self.period / len(self.user_waveform)
+        self.levels = self.user_waveform * self.amplitudehilevelvalue + self.offsetlolevelvalue
+
+        return { self.DWELL: self.dwell, self.LEVELS: self.levels, self.PERIOD: self.period }
+
+    def set_user_params(self):
+        params = self.get_user_params()
+        self.set_parameter(self.DWELL, params[self.DWELL])
+        self.upload_user_waveform(params[self.LEVELS])
+
+    def upload_user_waveform(self, levels):
+        # waveform already on the channel is not sent again
+        digest = hashlib.sha1(np.ascontiguousarray(levels, dtype='<f8').tobytes()).hexdigest()
+        if self.uploaded_waveforms.get(self.channel) == digest:
+            return
+
+        # shortest representation with 6 significant digits
+        encoded = ",".join(np.char.mod('%.6g', levels))
+        self.pending.append(f"ARB:VOLTAGE:CDW:LEVEL {encoded}, (@{self.channel})")
+        self.uploaded_waveforms[self.channel] = digest
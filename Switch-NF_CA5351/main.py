@@ -148,6 +148,16 @@ function.
             "1E10": 8
         }
 
+        # command queue to send several writes as one message
+        self.queue = []
+        self.queue_active = False
+        self.max_message_length = 1024
+        self.transactions_saved = 0
+
+        # last value written per SCPI header, actions are never skipped
+        self.shadow = dict()
+        self.shadow_exclude = ("INPUT:BIAS:CURRENT:AUTO",)
+
 
     def set_GUIparameter(self):
         GUIparameter =  {
@@ -206,86 +216,174 @@ function.
             self.savetype.append(True)
         
     def initialize(self):
-        self.port.write("*RST") # reset to default settings
-
-    def configure(self):
-        if self.backlight:
-            self.port.write(":DISPLAY:BRIGHTNESS 3")
-        else:
-            self.port.write(":DISPLAY:BRIGHTNESS 0")
+        self.queue = []
+        self.queue_active = False
+        self.transactions_saved = 0
+        self.shadow = dict()
+        self.write("*RST") # reset to default settings
 
-        self.port.write(f":ROUTE:TERMINALS {self.input}")
+    def deinitialize(self):
+        # nothing is left in the queue
+        self.stop_queue()
+        debug(f"NF CA5351: {self.transactions_saved} bus transactions saved by command queue")
 
-        if self.zero_check:
-            self.port.write(":INPUT:STATE ON")
-        else:
-            self.port.write(":INPUT:STATE OFF")
+    def configure(self):
+        self.start_queue()
+        try:
+            if self.backlight:
+                self.write(":DISPLAY:BRIGHTNESS 3")
+            else:
+                self.write(":DISPLAY:BRIGHTNESS 0")
 
-        if self.cs_enable:
+            self.write(f":ROUTE:TERMINALS {self.input}")
 
-            # reset ESR register
-            self.port.write("*CLS")
-            if self.auto_settings is False:
-                # set range
-                if self.cs_range == "Auto":
-                    self.port.write(":INPUT:BIAS:CURRENT:RANGE:AUTO ON")
-                else:
-                    self.port.write(f":INPUT:BIAS:CURRENT:RANGE {list(self.cs_ranges.keys()).index(self.cs_range)}")
-                # set CS level
-                self.port.write(f":INPUT:BIAS:CURRENT {self.cs_value}")
+            if self.zero_check:
+                self.write(":INPUT:STATE ON")
             else:
-                self.port.write(":INPUT:BIAS:CURRENT:AUTO EXEC; *OPC")
-                timeout = 20
-                telapsed = 0
-                completed = False
-                while telapsed < timeout:
-                    self.port.write("*OPC?")
-                    if int(self.port.read()) == 1:
-                        completed = True
-                        break
-                    time.sleep(0.5)
-                    telapsed += 0.5
-                if completed is False:
-                    raise Exception(f"auto settings timeout")
-
-            # CS setting or auto settings could raise errors
-            esr = self.read_esr()
-
-            if (esr & (1<<4)):
-                raise Exception("execution error during current suppression setup - verify CS value and range")
-
-            # enable CS
-            self.port.write(":INPUT:BIAS:CURRENT:STATE ON")
-
-        # set gain
-        self.port.write(f":INPUT:GAIN {self.gains[self.gain]}")
-
-        # set filter
-        if self.filter_enable:
-            if self.filter_rtime == "Auto":
-                self.port.write(":INPUT:FILTER:TIME:AUTO ON")
-            else:
-                self.port.write(f":INPUT:FILTER:TIME {list(self.filter_rtimes.keys()).index(self.filter_rtime)}")
+                self.write(":INPUT:STATE OFF")
+
+            if self.cs_enable:
+
+                # reset ESR register
+                self.write("*CLS")
+                if self.auto_settings is False:
+                    # set range
+                    if self.cs_range == "Auto":
+                        self.write(":INPUT:BIAS:CURRENT:RANGE:AUTO ON")
+                    else:
+                        self.write(f":INPUT:BIAS:CURRENT:RANGE {list(self.cs_ranges.keys()).index(self.cs_range)}")
+                    # set CS level
+                    self.write(f":INPUT:BIAS:CURRENT {self.cs_value}")
+                else:
+                    self.write(":INPUT:BIAS:CURRENT:AUTO EXEC; *OPC")
+                    # the automatic adjustment chooses range and level on its own
+                    for key in ("INPUT:BIAS:CURRENT", "INPUT:BIAS:CURRENT:RANGE", "INPUT:BIAS:CURRENT:RANGE:AUTO"):
+                        self.shadow.pop(key, None)
+                    timeout = 20
+                    telapsed = 0
+                    completed = False
+                    while telapsed < timeout:
+                        if int(self.query("*OPC?")) == 1:
+                            completed = True
+                            break
+                        time.sleep(0.5)
+                        telapsed += 0.5
+                    if completed is False:
+                        raise Exception(f"auto settings timeout")
+
+                # CS setting or auto settings could raise errors
+                esr = self.read_esr()
+
+                if (esr & (1<<4)):
+                    raise Exception("execution error during current suppression setup - verify CS value and range")
+
+                # enable CS
+                self.write(":INPUT:BIAS:CURRENT:STATE ON")
+
+            # set gain
+            self.write(f":INPUT:GAIN {self.gains[self.gain]}")
+
+            # set filter
+            if self.filter_enable:
+                if self.filter_rtime == "Auto":
+                    self.write(":INPUT:FILTER:TIME:AUTO ON")
+                else:
+                    self.write(f":INPUT:FILTER:TIME {list(self.filter_rtimes.keys()).index(self.filter_rtime)}")
 
-            self.port.write(":INPUT:FILTER:STATE ON")
+                self.write(":INPUT:FILTER:STATE ON")
+        finally:
+            self.stop_queue()
 
     def call(self):
         retarr = []
         if (self.cs_enable and self.cs_range == "Auto"):
-            self.port.write(":INPUT:BIAS:CURRENT?")
-            retarr.append(float(self.port.read()))
-            self.port.write(":INPUT:BIAS:CURRENT:RANGE?")
-            id = int(self.port.read())
+            retarr.append(float(self.query(":INPUT:BIAS:CURRENT?")))
+            id = int(self.query(":INPUT:BIAS:CURRENT:RANGE?"))
             retarr.append(list(self.cs_ranges.items())[id][1])
         if self.filter_enable and self.filter_rtime == "Auto":
-            self.port.write(":INPUT:FILTER:TIME?")
-            id = int(self.port.read())
+            id = int(self.query(":INPUT:FILTER:TIME?"))
             retarr.append(list(self.filter_rtimes.items())[id][1])
             
         return retarr
 
     # check ESR (standard event status register)
     def read_esr(self):
-        self.port.write("*ESR?")
-        answer = int(self.port.read())
+        answer = int(self.query("*ESR?"))
         return answer
+
+    # COMMAND QUEUE
+
+    def write(self, cmd):
+        # skip settings whose value has not changed since the last write
+        if self.shadow_unchanged(cmd):
+            return False
+        self.shadow_update(cmd)
+
+        # writes are buffered while the command queue is active
+        if self.queue_active:
+            self.queue.append(cmd)
+        else:
+            self.port.write(cmd)
+        return True
+
+    def query(self, cmd):
+        self.flush()
+        self.shadow_update(cmd)
+        self.port.write(cmd)
+        return self.port.read()
+
+    def start_queue(self):
+        self.queue_active = True
+
+    def stop_queue(self):
+        self.flush()
+        self.queue_active = False
+
+    def flush(self):
+        # queued commands are sent as few ';' joined messages within the byte limit
+        messages = []
+        for cmd in self.queue:
+            # absolute header path, otherwise it would be relative to the previous command
+            if not cmd.startswith(("*", ":")):
+                cmd = ":" + cmd
+            if messages and len(messages[-1]) + len(cmd) + 1 <= self.max_message_length:
+                messages[-1] += ";" + cmd
+            else:
+                messages.append(cmd)
+
+        for message in messages:
+            self.port.write(message)
+
+        self.transactions_saved += len(self.queue) - len(messages)
+        self.queue = []
+
+    # STATE SHADOW
+
+    def shadow_unchanged(self, cmd):
+        # only single commands are skipped, compound messages are always sent
+        if ";" in cmd:
+            return False
+        key, value = self.shadow_key(cmd)
+        return key is not None and self.shadow.get(key) == value
+
+    def shadow_update(self, cmd):
+        # every setting of a (compound) message is recorded
+        for part in cmd.split(";"):
+            # reset and recall invalidate the state shadow
+            if part.strip().startswith(("*RST", "*RCL")):
+                self.shadow = dict()
+                continue
+            key, value = self.shadow_key(part)
+            if key is not None:
+                self.shadow[key] = value
+
+    def shadow_key(self, cmd):
+        # settings are shadowed by header, e.g. ':INPUT:GAIN 3' -> 'INPUT:GAIN': '3'
+        cmd = cmd.strip()
+        if cmd.startswith("*") or "?" in cmd or " " not in cmd:
+            return None, None
+        header, value = cmd.split(" ", 1)
+        header = header.lstrip(":").upper()
+        if header in self.shadow_exclude:
+            return None, None
+        return header, value.strip()